@@ -0,0 +1,267 @@
+'''
+Title: M8 Sample Data Cleaner - Benchmarks
+
+Generates a reproducible synthetic sample library and times the stages of main.py against it. Every stage runs in its
+own process on a fresh copy of the library so the timings and peak memory of one stage do not leak into the next.
+Results are written as JSON so runs from different versions can be compared with --compare.
+
+Example:
+python benchmark.py --files 2000 --depth 3 --output results.json
+python benchmark.py --files 2000 --depth 3 --output new.json --compare results.json
+python benchmark.py --stages name_transforms --names 200000 --output names.json
+
+Converting AIFF, FLAC and MP3 files to WAV goes through pydub, which needs ffmpeg on the PATH. MP3 files are only
+generated when the installed libsndfile can write them.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import soundfile as sf
+import main
+
+# Words the generated names are built from
+NAME_WORDS = ['Kick', 'Snare', 'Hats', 'Open', 'Closed', 'Loops', 'Bass', 'Sub', 'Pads', 'Vocal', 'Chops', 'Percussion',
+              'Cymbals', 'Claps', 'Toms', 'Risers', 'Impacts', 'Drums', 'Synth', 'Leads', 'Stabs', 'Textures', 'Foley',
+              '808', '909', 'Dry', 'Wet', '(Copy)', '&', '-', '120bpm', 'Am', 'One Shot', 'Vol.2', 'Final_v3']
+
+# Audio formats and the subtypes generated for each
+AUDIO_FORMATS = {
+    '.wav': ('WAV', ['PCM_16', 'PCM_24', 'PCM_32', 'FLOAT']),
+    '.aiff': ('AIFF', ['PCM_16', 'PCM_24']),
+    '.flac': ('FLAC', ['PCM_16', 'PCM_24']),
+    '.mp3': ('MP3', ['MPEG_LAYER_III']),
+}
+
+# Files that are not audio and should be cleaned out
+JUNK_FILES = ['.asd', '.alc', '.DS_Store', '.txt']
+
+# The stages that can be benchmarked, each with the function and a function of the options giving its arguments
+STAGES = {
+    'convert_to_wav': (main.convert_to_wav, lambda options: (False, options.workers)),
+    'check_files': (main.check_files, lambda options: ()),
+    'delete_non_wav_files': (main.delete_non_wav_files, lambda options: (options.io_concurrency,)),
+    'remove_plural_suffixes': (main.remove_plural_suffixes, lambda options: ()),
+    'remove_characters_from_filenames': (main.remove_characters_from_filenames, lambda options: ()),
+    'remove_vowels': (main.remove_vowels, lambda options: ()),
+    'truncate_names': (main.truncate_names, lambda options: (12,)),
+    'convert_bit_depth': (main.convert_bit_depth, lambda options: (16, options.workers, True)),
+    'check_bit_depth': (main.check_bit_depth, lambda options: ()),
+    'split_and_trim_all': (main.split_and_trim_all, lambda options: (250, -60, options.workers)),
+}
+
+# The rename stages the name_transforms benchmark compiles into one transform. abbreviate_filenames is left out as it
+# needs the WordNet corpus
+NAME_TRANSFORM_STAGES = [
+    (main.remove_plural_suffixes_from_string,),
+    (main.remove_characters_from_string,),
+    (main.remove_vowels_from_string,),
+    (main.truncate_string, 12),
+]
+
+# Make up a sample name of roughly the given number of characters
+def random_name(rng, length):
+    words = []
+    while len(' '.join(words)) < length:
+        words.append(rng.choice(NAME_WORDS))
+    return ' '.join(words)[:max(1, length)].strip() or 'Sample'
+
+# A short tone with silence on both sides so there is something to trim
+def make_audio(np_rng, samplerate, channels, duration):
+    frames = int(samplerate * duration)
+    pad = frames // 4
+    t = np.arange(frames - 2 * pad) / samplerate
+    tone = 0.5 * np.sin(2 * np.pi * np_rng.uniform(50, 2000) * t)
+    data = np.zeros((frames, channels))
+    data[pad:frames - pad] = tone[:, None]
+    return data
+
+# Build a synthetic sample library in root_dir. The same seed always gives the same tree
+def generate_library(root_dir, files=1000, depth=3, name_length=24, junk_ratio=0.1, duration=0.5, seed=0):
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    writable = sf.available_formats()
+    formats = [ext for ext, (file_format, subtypes) in AUDIO_FORMATS.items() if file_format in writable]
+
+    # Lay out the directories first, each level branching a few times
+    dirs = [root_dir]
+    frontier = [root_dir]
+    for level in range(depth):
+        next_frontier = []
+        for parent in frontier:
+            for _ in range(rng.randint(1, 4)):
+                path = os.path.join(parent, random_name(rng, rng.randint(4, name_length)))
+                os.makedirs(path, exist_ok=True)
+                next_frontier.append(path)
+        dirs.extend(next_frontier)
+        frontier = next_frontier
+
+    for i in range(files):
+        parent = rng.choice(dirs)
+        name = f"{random_name(rng, rng.randint(4, name_length))} {i}"
+        if rng.random() < junk_ratio:
+            with open(os.path.join(parent, name + rng.choice(JUNK_FILES)), 'w') as f:
+                f.write('junk')
+            continue
+        ext = rng.choice(formats)
+        file_format, subtypes = AUDIO_FORMATS[ext]
+        samplerate = rng.choice([44100, 48000])
+        data = make_audio(np_rng, samplerate, rng.choice([1, 2]), duration)
+        sf.write(os.path.join(parent, name + ext), data, samplerate, format=file_format, subtype=rng.choice(subtypes))
+
+# Count the files and bytes in a tree
+def tree_size(root_dir):
+    count = 0
+    size = 0
+    for root, dirs, files in os.walk(root_dir):
+        for file in files:
+            count += 1
+            size += os.path.getsize(os.path.join(root, file))
+    return count, size
+
+# Peak resident memory of this process and its finished children in MB
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # Windows has no resource module but psutil knows the peak working set
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    scale = 1 if sys.platform == 'darwin' else 1024
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak * scale / 2 ** 20
+
+# Runs inside a fresh process, times one stage over root_dir and sends the result back
+def stage_process(name, root_dir, options, queue):
+    func, arguments = STAGES[name]
+    start_time = time.perf_counter()
+    func(root_dir, *arguments(options))
+    elapsed = time.perf_counter() - start_time
+    queue.put((elapsed, peak_rss_mb()))
+
+# Benchmark one stage on a fresh copy of the library
+def benchmark_stage(name, library_dir, work_dir, options):
+    root_dir = os.path.join(work_dir, name)
+    shutil.copytree(library_dir, root_dir)
+    files, size = tree_size(root_dir)
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=stage_process, args=(name, root_dir, options, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"{name} failed with exit code {process.exitcode}")
+    elapsed, peak = queue.get()
+    shutil.rmtree(root_dir, ignore_errors=True)
+    return {
+        'seconds': elapsed,
+        'files': files,
+        'bytes': size,
+        'files_per_sec': files / elapsed if elapsed else None,
+        'mb_per_sec': size / 2 ** 20 / elapsed if elapsed else None,
+        'peak_rss_mb': peak,
+    }
+
+# Time the compiled name transforms on made up names. Needs no library and runs in this process
+def benchmark_name_transforms(options):
+    names_per_sec = main.benchmark_name_transforms(NAME_TRANSFORM_STAGES, options.names, options.seed)
+    return {
+        'names': options.names,
+        'distinct_names_per_sec': names_per_sec['distinct'],
+        'repeated_names_per_sec': names_per_sec['repeated'],
+    }
+
+# Describe the code and machine the results came from
+def run_metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'soundfile': sf.__version__,
+    }
+
+# Print how the files/s of each stage changed against an earlier results file
+def compare_results(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    print(f"\nCompared with {baseline_path}:")
+    for name, result in results.items():
+        old = baseline.get(name)
+        if name == 'name_transforms':
+            if old:
+                ratio = result['distinct_names_per_sec'] / old['distinct_names_per_sec']
+                print(f"{name}: {old['distinct_names_per_sec']:,.0f} -> {result['distinct_names_per_sec']:,.0f} "
+                      f"distinct names/s (x{ratio:.2f})")
+            continue
+        if not old or not old['files_per_sec'] or not result['files_per_sec']:
+            continue
+        ratio = result['files_per_sec'] / old['files_per_sec']
+        print(f"{name}: {old['files_per_sec']:.1f} -> {result['files_per_sec']:.1f} files/s (x{ratio:.2f}), "
+              f"peak {old['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the M8 sample data cleaner')
+    parser.add_argument('--files', type=int, default=1000, help='number of files in the generated library')
+    parser.add_argument('--depth', type=int, default=3, help='depth of the generated directory tree')
+    parser.add_argument('--name-length', type=int, default=24, help='longest generated name in characters')
+    parser.add_argument('--junk-ratio', type=float, default=0.1, help='share of the files that are not audio')
+    parser.add_argument('--duration', type=float, default=0.5, help='length of each sample in seconds')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated library')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES) + ['name_transforms'],
+                        default=list(STAGES) + ['name_transforms'],
+                        help='stages to time, name_transforms times the compiled rename transforms on their own')
+    parser.add_argument('--names', type=int, default=100000, help='number of names the name_transforms benchmark uses')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for the converting stages')
+    parser.add_argument('--io-concurrency', type=int, default=1, help='filesystem operations kept in flight')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='earlier JSON results to compare against')
+    parser.add_argument('--library', help='use or keep the generated library in this directory')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    options = parse_arguments()
+    config = {key: getattr(options, key) for key in ['files', 'depth', 'name_length', 'junk_ratio', 'duration',
+                                                     'seed', 'workers', 'io_concurrency', 'names']}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        library_dir = options.library or os.path.join(work_dir, 'library')
+        if not os.path.isdir(library_dir) and any(name in STAGES for name in options.stages):
+            print(f"Generating {options.files} files in {library_dir}")
+            generate_library(library_dir, options.files, options.depth, options.name_length, options.junk_ratio,
+                             options.duration, options.seed)
+
+        results = {}
+        for name in options.stages:
+            print(f"Benchmarking {name}")
+            if name == 'name_transforms':
+                results[name] = result = benchmark_name_transforms(options)
+                print(f"{name}: {result['distinct_names_per_sec']:,.0f} distinct names/s, "
+                      f"{result['repeated_names_per_sec']:,.0f} repeated names/s")
+                continue
+            results[name] = benchmark_stage(name, library_dir, work_dir, options)
+            result = results[name]
+            print(f"{name}: {result['seconds']:.2f}s, {result['files_per_sec']:.1f} files/s, "
+                  f"{result['mb_per_sec']:.1f} MB/s, peak {result['peak_rss_mb']:.0f} MB")
+
+    with open(options.output, 'w') as f:
+        json.dump({'meta': run_metadata(), 'config': config, 'results': results}, f, indent=2)
+    print(f"Results written to {options.output}")
+
+    if options.compare:
+        compare_results(results, options.compare)
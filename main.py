@@ -14,7 +14,7 @@ and are comfortable with the configuration you have, then you may feel free to c
 
 Description: This is my first public python project. The goal of this script is to prepare a directory tree of samples
 for use in the dirtywave m8. This script does a few things. Each function is designed to work independantly so feel free
-to comment out functions you don't wish to use in the main program. You can even reorder them if you prefer. The default
+to leave out functions you don't wish to use with --stages. You can even reorder them if you prefer. The default
 state is biased towards my preferences and the full script strips as much as possible by attempting to preserve
 legibility.
 
@@ -31,428 +31,2331 @@ Functionality:
 input for the second argument
 10) check_bit_depth() Determines whether the bit_depth is legal for use in the M8
 11) split_and_trim_all() Removes silences from the beginning and end of a file. Second input argument determines the
-threshold in milliseconds to detect in order for slicing to occur
+threshold in milliseconds to detect in order for slicing to occur, third argument is the level in dBFS below which audio
+counts as silence
+12) process_audio() Does the work of convert_to_wav(), convert_bit_depth(), check_bit_depth() and optionally
+split_and_trim_all() while decoding and writing each file only once, and can resample to a target sample rate
+13) deduplicate_samples() Finds samples holding the same audio under different names and optionally replaces them
+with hard links to a single copy
 
-Further instructions are listed in the main program
+Run python main.py --help for the options, further instructions are listed in the main program
 
 Feel free to modify this code to fit your needs or make contributions if you feel, Just don't redistribute as your own.
 If you feel like your special case warrants attention, feel free to reach out at jack.lion710@gmail.com
 '''
 
+import time
+
+# Taken before the other imports so --import-time can report how long loading this module took
+START_TIME = time.perf_counter()
+
 import os
+import sys
 import stat
-import nltk
-import multiprocessing
-import multiprocessing.pool
-import soundfile as sf
-import pydub
-from pydub import AudioSegment
-from pathlib import Path
 import re
+import hashlib
+import struct
+import collections
+import functools
+import gzip
+import random
+import itertools
+import io
+import json
+import logging
+import threading
+import contextlib
+import importlib
+import argparse
+
+'''
+Lazy imports
+nltk, pydub, soundfile, NumPy, multiprocessing and the other slow to import modules below are only imported the first
+time one of their attributes is used, so a run only pays for the modules its stages actually need. Checking the WAVs
+of a tree only reads their headers and never loads any of them.
+'''
+
+# Seconds each lazily imported module took to import the first time it was used
+IMPORT_TIMES = {}
+
+# Names of the lazily imported modules, in the order they are declared
+LAZY_MODULES = []
+
+# Stand in for a module that imports it the first time one of its attributes is used. The module then takes the place
+# of the stand in under global_name, so later uses go straight to it. module_names are imported together, the first
+# one is the module handed out
+class LazyModule:
+    def __init__(self, global_name, *module_names):
+        self._global_name = global_name
+        self._module_names = module_names
+        LAZY_MODULES.append(module_names[0])
+
+    def __getattr__(self, attr):
+        start_time = time.perf_counter()
+        modules = [importlib.import_module(name) for name in self._module_names]
+        IMPORT_TIMES.setdefault(self._module_names[0], time.perf_counter() - start_time)
+        globals()[self._global_name] = modules[0]
+        return getattr(modules[0], attr)
+
+nltk = LazyModule('nltk', 'nltk')
+pydub = LazyModule('pydub', 'pydub')
+sf = LazyModule('sf', 'soundfile')
+np = LazyModule('np', 'numpy')
+multiprocessing = LazyModule('multiprocessing', 'multiprocessing', 'multiprocessing.pool')
+futures = LazyModule('futures', 'concurrent.futures')
+asyncio = LazyModule('asyncio', 'asyncio')
+sqlite3 = LazyModule('sqlite3', 'sqlite3')
+shutil = LazyModule('shutil', 'shutil')
+cProfile = LazyModule('cProfile', 'cProfile')
+pstats = LazyModule('pstats', 'pstats')
+tracemalloc = LazyModule('tracemalloc', 'tracemalloc')
+
+# Log how long this module took to import and how long each lazily imported module took the first time it was used
+def log_import_times():
+    logger.info('Import times:')
+    logger.info('  main: %.1f ms', MODULE_IMPORT_TIME * 1000)
+    for name in LAZY_MODULES:
+        if name in IMPORT_TIMES:
+            logger.info('  %s: %.1f ms on first use', name, IMPORT_TIMES[name] * 1000)
+        elif name in sys.modules:
+            logger.info('  %s: imported by another module', name)
+        else:
+            logger.info('  %s: not imported', name)
 
 def run_function_in_process(func, *args):
     with multiprocessing.pool.ThreadPool(processes=1) as pool:
         result = pool.apply(func, args)
     return result
 
-# Enables write permissions for every file in the directory
-def enable_write_permissions(root_dir):
-    # Recursively traverse the directory tree
-    for root, dirs, files in os.walk(root_dir):
-        # Enable write permissions for all files
-        for file in files:
-            file_path = os.path.join(root, file)
-            os.chmod(file_path, stat.S_IWRITE)
+'''
+Instrumentation
+Counters and timers for the whole run, kept for the main process and gathered back from the worker processes. Messages
+go through a leveled logger so the per file ones cost next to nothing unless debug logging is on. cProfile and
+tracemalloc can be switched on for a single stage.
+'''
 
-# Discard non audio file types and convert remaining files into .WAV
-def convert_to_wav(root_dir, verbose_permission=True):
-    for root, dirs, files in os.walk(root_dir):
-        for file in files:
-            file_path = os.path.join(root, file)
-            file_extension = os.path.splitext(file_path)[1]
+logger = logging.getLogger('m8_data_cleaner')
+
+COUNTERS = collections.Counter()
+TIMERS = collections.defaultdict(float)
+STATS_LOCK = threading.Lock()
+
+# The stage being profiled, if any, and what was captured for it
+PROFILE = {'stage': None, 'profiler': None, 'memory': False, 'peak_memory': 0}
+
+# Add to one of the run counters
+def count_stat(name, amount=1):
+    with STATS_LOCK:
+        COUNTERS[name] += amount
+
+# Add the time spent inside the block to one of the run timers
+@contextlib.contextmanager
+def timed(name):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        with STATS_LOCK:
+            TIMERS[name] += elapsed
+
+# Hand back the counters and timers gathered so far and start again from zero
+def take_stats():
+    with STATS_LOCK:
+        stats = dict(COUNTERS), dict(TIMERS)
+        COUNTERS.clear()
+        TIMERS.clear()
+    return stats
+
+# Add counters and timers gathered in a worker process to the ones of this process
+def merge_stats(stats):
+    counters, timers = stats
+    with STATS_LOCK:
+        COUNTERS.update(counters)
+        for name, seconds in timers.items():
+            TIMERS[name] += seconds
+
+# Profile every call of one stage with cProfile, and with memory also track its peak memory with tracemalloc. The
+# stage then always runs in the main process
+def enable_profiling(stage_name, memory=False):
+    PROFILE.update(stage=stage_name, profiler=cProfile.Profile(), memory=memory, peak_memory=0)
+    if memory:
+        tracemalloc.start()
+
+# Run a stage on a file, timing it and profiling it if it is the stage being profiled
+def call_stage(stage, file_path, args):
+    if PROFILE['stage'] != stage.__name__:
+        with timed(stage.__name__):
+            return stage(file_path, *args)
+    if PROFILE['memory']:
+        tracemalloc.reset_peak()
+    PROFILE['profiler'].enable()
+    try:
+        with timed(stage.__name__):
+            return stage(file_path, *args)
+    finally:
+        PROFILE['profiler'].disable()
+        if PROFILE['memory']:
+            PROFILE['peak_memory'] = max(PROFILE['peak_memory'], tracemalloc.get_traced_memory()[1])
+
+# Gather the counters, timers and profile of the run into a dict
+def run_report(top=20):
+    report = {
+        'counters': dict(sorted(COUNTERS.items())),
+        'timers': {name: round(seconds, 6) for name, seconds in sorted(TIMERS.items(), key=lambda item: -item[1])},
+    }
+    if PROFILE['profiler'] is not None:
+        PROFILE['profiler'].create_stats()
+    # A profiled stage that never ran on a file has nothing to report
+    if PROFILE['profiler'] is not None and PROFILE['profiler'].stats:
+        stream = io.StringIO()
+        pstats.Stats(PROFILE['profiler'], stream=stream).sort_stats('cumulative').print_stats(top)
+        report['profile'] = {'stage': PROFILE['stage'], 'top_functions': stream.getvalue()}
+        if PROFILE['memory']:
+            report['profile']['peak_memory_bytes'] = PROFILE['peak_memory']
+    return report
+
+# Log the end of run report and optionally write it to report_path as JSON
+def log_run_report(report_path=None):
+    report = run_report()
+    logger.info('Counters:')
+    for name, value in report['counters'].items():
+        logger.info('  %s: %s', name, value)
+    logger.info('Timers:')
+    for name, seconds in report['timers'].items():
+        logger.info('  %s: %.3fs', name, seconds)
+    if 'profile' in report:
+        logger.info('Profile of %s:\n%s', report['profile']['stage'], report['profile']['top_functions'])
+        if 'peak_memory_bytes' in report['profile']:
+            logger.info('Peak memory of %s: %.1f MB', report['profile']['stage'],
+                        report['profile']['peak_memory_bytes'] / 2 ** 20)
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+'''
+Directory scanner
+The tree is walked with os.scandir and every entry is handed on as soon as it is found, so the stages can start on the
+first files while the rest of the tree is still being scanned. Only the directories still to visit are held in memory.
+A scan filter picks the files the per file stages process by extension and size, the others are never opened.
+'''
+
+# Which files the per file stages process. include and exclude are collections of extensions such as {'.wav', '.aif'},
+# matched without regard to case, and min_size and max_size are in bytes. None leaves that check out
+ScanFilter = collections.namedtuple('ScanFilter', 'include exclude min_size max_size', defaults=(None, None, None, None))
+
+# A file or directory found by the scanner, with the size and modification time of the stat the scan already made.
+# selected is False for files the scan filter left out, which are not stat'ed at all when their extension rules them out
+class ScanEntry:
+    __slots__ = ('path', 'is_dir', 'size', 'mtime_ns', 'selected')
+
+    def __init__(self, path, is_dir, size=None, mtime_ns=None, selected=True):
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.selected = selected
+
+    def __repr__(self):
+        return f'ScanEntry({self.path!r}, is_dir={self.is_dir}, size={self.size}, selected={self.selected})'
+
+# Lower case a collection of extensions and give each its leading dot
+def normalize_extensions(extensions):
+    if extensions is None:
+        return None
+    return {'.' + extension.lower().lstrip('.') for extension in extensions}
+
+# Turn a directory entry from os.scandir into a scan entry, None for entries that are not part of the samples. Files are
+# only stat'ed when with_stat is set or the size filter needs it
+def scan_entry(entry, include, exclude, scan_filter, with_stat):
+    if entry.is_dir():
+        return ScanEntry(entry.path, True)
+    # The manifest caches and the journals live in the tree but are not samples, and neither are the temporary files
+    # the stages and renames of other shards are writing
+    if (entry.name.startswith(MANIFEST_CACHE_NAME) or entry.name.startswith(JOURNAL_NAME) or
+            TEMP_MARKER in entry.name):
+        return None
+    extension = os.path.splitext(entry.name)[1].lower()
+    if (include is not None and extension not in include) or (exclude is not None and extension in exclude):
+        return ScanEntry(entry.path, False, selected=False)
+    if not (with_stat or scan_filter.min_size is not None or scan_filter.max_size is not None):
+        return ScanEntry(entry.path, False)
+    # On Windows the stat comes for free with the directory listing, elsewhere it is a single call cached on the entry
+    st = entry.stat()
+    selected = ((scan_filter.min_size is None or st.st_size >= scan_filter.min_size) and
+                (scan_filter.max_size is None or st.st_size <= scan_filter.max_size))
+    return ScanEntry(entry.path, False, st.st_size, st.st_mtime_ns, selected)
+
+# List a single directory into scan entries, adding the directories below it to pending unless descend says otherwise
+def scan_directory(dir_path, pending, include, exclude, scan_filter, with_stat, descend=None):
+    records = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    record = scan_entry(entry, include, exclude, scan_filter, with_stat)
+                except OSError as e:
+                    logger.warning('Unable to scan %s: %s', entry.path, e)
+                    count_stat('errors')
+                    continue
+                if record is None:
+                    continue
+                # Like os.walk, links to directories are listed but not followed
+                if record.is_dir and not entry.is_symlink() and (descend is None or descend(record.path)):
+                    pending.append(record.path)
+                records.append(record)
+    except OSError as e:
+        logger.warning('Unable to scan %s: %s', dir_path, e)
+        count_stat('errors')
+    return records
+
+# Walk the tree under root_dir yielding a scan entry for every file and directory, one directory listing at a time. A
+# directory is always yielded before anything inside it. with_stat records the size and modification time of every
+# file, which the manifest cache uses. descend is called with each directory found and can return False to leave what
+# is inside it out of the scan
+def iter_tree(root_dir, scan_filter=None, with_stat=False, descend=None):
+    scan_filter = scan_filter or ScanFilter()
+    include = normalize_extensions(scan_filter.include)
+    exclude = normalize_extensions(scan_filter.exclude)
+    pending = [root_dir]
+    while pending:
+        dir_path = pending.pop()
+        with timed('scan'):
+            records = scan_directory(dir_path, pending, include, exclude, scan_filter, with_stat, descend)
+        dirs = sum(record.is_dir for record in records)
+        count_stat('dirs_seen', dirs)
+        count_stat('files_seen', len(records) - dirs)
+        count_stat('files_filtered', sum(not record.selected for record in records))
+        yield from records
+
+# Scan the directory tree into lists of every file and directory path
+def scan_tree(root_dir):
+    files = []
+    dirs = []
+    for entry in iter_tree(root_dir):
+        (dirs if entry.is_dir else files).append(entry.path)
+    return files, dirs
+
+# Stream the files the scan filter selected out of the scanner, collecting the directories in dirs and the paths of
+# the files left out in skipped along the way. With a shard only the files of that shard are streamed, and when it is
+# sharded by top level directory the directories of the other shards are not scanned at all
+def scan_files(root_dir, dirs, skipped, scan_filter=None, with_stat=False, shard=None):
+    descend = None
+    if shard is not None and shard.by == 'top':
+        descend = lambda dir_path: in_shard(root_dir, dir_path, shard)
+    for entry in iter_tree(root_dir, scan_filter, with_stat, descend):
+        if entry.is_dir:
+            dirs.append(entry.path)
+        elif entry.selected and (shard is None or in_shard(root_dir, entry.path, shard)):
+            yield entry
+        else:
+            skipped.append(entry.path)
+
+'''
+Pipeline engine
+Every file the scanner finds is pushed through the chain of stages. A stage is a tuple of a per file function followed
+by its extra arguments. Each per file function takes the current path of the file and returns its new path, or None
+when the file was removed so the remaining stages skip it.
+'''
+
+# Push every file in the tree through the configured chain of stages. The first stages start on the files while the
+# tree is still being scanned. With more than one worker the transcoding stages run in a process pool while the rest of
+# the chain stays in this process. With an io_concurrency above one the deletes, permission changes and renames keep
+# that many filesystem operations in flight. With use_cache the stages each file already went through on earlier runs
+# are looked up in the manifest cache and skipped, and the run keeps a journal so an interrupted run can be finished
+# with resume. A deduplicate stage leaves duplicate samples out of the other stages. Files the scan_filter leaves out
+# skip the per file stages but are still renamed. With a shard only the files of that shard go through the stages, with
+# a manifest cache and journal of its own, and the renames are left for merge_shards. Duplicates are only found within
+# a shard
+def run_pipeline(root_dir, stages, workers=1, use_cache=False, io_concurrency=1, scan_filter=None, resume=False,
+                 shard=None):
+    # Resuming and merging shards rely on the manifest cache to know which files are done
+    use_cache = use_cache or resume or shard is not None
+    if shard is not None:
+        stages = [stage for stage in stages if stage[0] is not rename_file]
+    cache = open_manifest_cache(root_dir, shard) if use_cache else None
+    journal = None
+    completed = False
+    try:
+        remaining_plan = recover_journal(root_dir, cache, resume, shard) if cache is not None else None
+        journal = Journal(root_dir, shard) if cache is not None else None
+        if shard is not None:
+            set_shard_value(cache, 'results', None)
+        if remaining_plan is not None:
+            # The interrupted run had already finished its other stages and was renaming, so only its plan is left
+            with timed('apply_renames'):
+                apply_renames(remaining_plan, cache, io_concurrency, journal)
+            files, dirs = scan_tree(root_dir)
+        else:
+            files = run_stages_and_renames(root_dir, stages, workers, cache, journal, io_concurrency, scan_filter,
+                                           shard)
+        if shard is not None:
+            save_shard_results(cache, stages)
+        completed = True
+    finally:
+        if journal is not None:
+            journal.checkpoint(cache, force=True)
+            # A finished run leaves nothing to resume
+            if completed:
+                journal.finish()
+            else:
+                journal.close()
+        if cache is not None:
+            cache.close()
+    return files
+
+# Scan the tree, push the files through the chain and then plan and apply the renames. Returns the final file paths
+def run_stages_and_renames(root_dir, stages, workers=1, cache=None, journal=None, io_concurrency=1, scan_filter=None,
+                           shard=None):
+    dirs = []
+    skipped = []
+    files = scan_files(root_dir, dirs, skipped, scan_filter, cache is not None, shard)
+    # Renames are planned for the whole tree once the other stages are done
+    rename_stages = [args for stage, *args in stages if stage is rename_file]
+    dedupe_modes = [args[0] if args else 'skip' for stage, *args in stages if stage is deduplicate]
+    stages = [stage for stage in stages if stage[0] is not rename_file and stage[0] is not deduplicate]
+    duplicates = {}
+    if dedupe_modes:
+        # Duplicates can only be found once every file is known, so the stages wait for the whole scan
+        files = list(files)
+        duplicates = find_duplicates(files)
+        report_duplicates(duplicates)
+        files = [entry for entry in files if (entry.path if isinstance(entry, ScanEntry) else entry) not in duplicates]
+    for kind, segment in split_stage_segments(stages, workers, io_concurrency):
+        if kind == 'process':
+            files = run_stages_in_pool(files, segment, workers, cache, journal)
+        elif kind == 'io':
+            files = run_stages_concurrently(files, segment, io_concurrency, cache, journal)
+        else:
+            files = run_stages(files, segment, cache, journal)
+    files = [entry.path if isinstance(entry, ScanEntry) else entry for entry in files]
+    if 'link' in dedupe_modes:
+        files += link_duplicates(duplicates, files)
+    else:
+        files += list(duplicates)
+    files += skipped
+
+    if rename_stages:
+        with timed('plan_renames'):
+            plan = plan_renames(files, dirs, rename_stages)
+        with timed('apply_renames'):
+            renamed = apply_renames(plan, cache, io_concurrency, journal)
+        files = final_file_paths(files, dirs, renamed)
+    return files
+
+# Name a stage and its settings so the manifest cache can tell whether a file already went through it
+def stage_key(stage, args):
+    # The lists check stages collect problem files in are not part of the settings
+    settings = tuple(arg for arg in args if not isinstance(arg, list))
+    return f'{stage.__name__}{settings!r}'
+
+# Run the stages for a single file, skipping the ones listed in done. Returns the new path of the file and the stages
+# it has now been through
+def apply_stages(file_path, stages, done):
+    done = set(done)
+    for stage, *args in stages:
+        key = stage_key(stage, args)
+        if key in done:
+            continue
+        problems = len(args[0]) if stage in CHECK_STAGES else None
+        file_path = call_stage(stage, file_path, args)
+        if file_path is None:
+            # The file was deleted so there is nothing left to do with it
+            break
+        # A check only counts as done when it found nothing wrong, so it runs again until the file is fixed
+        if stage in CACHEABLE_STAGES or (problems is not None and len(args[0]) == problems):
+            done.add(key)
+    return file_path, done
+
+# Get the path of a file and the stages it already went through. Files straight from the scanner come as scan entries
+# carrying the stat the scan already made
+def lookup_entry(cache, entry):
+    if isinstance(entry, ScanEntry):
+        file_path, known_stat = entry.path, (entry.size, entry.mtime_ns) if entry.size is not None else None
+    else:
+        file_path, known_stat = entry, None
+    done = lookup_manifest_cache(cache, file_path, known_stat) if cache is not None else set()
+    return file_path, done
+
+# Record in the manifest cache and the journal what the stages did to a file
+def record_stage_result(cache, journal, old_path, new_path, done, new_done):
+    if cache is None:
+        return
+    changed = new_path != old_path or new_done != done
+    row = update_manifest_cache(cache, old_path, new_path, done, new_done)
+    if journal is not None:
+        if changed:
+            journal.write('end', path=old_path, row=row)
+        journal.checkpoint(cache)
+
+# Push each file through the stages one after another, dropping files that a stage removed. A file the stages fail on
+# is reported and skipped like in the pool
+def run_stages(files, stages, cache=None, journal=None):
+    remaining_files = []
+    for entry in files:
+        file_path, done = lookup_entry(cache, entry)
+        if journal is not None:
+            journal.write('begin', path=file_path)
+        result = run_stages_safely(file_path, stages, done)
+        new_path, failed = collect_stage_result(file_path, done, result, [], cache, journal)
+        if new_path is not None:
+            remaining_files.append(new_path)
+    return remaining_files
+
+# Check whether a stage only touches its own file and can run in a worker process
+def is_parallel_stage(stage, *args):
+    if stage is convert_file_to_wav:
+        # Asking the user for permission needs the console so it has to stay in the main process
+        verbose_permission = args[0] if args else True
+        return not verbose_permission
+    return stage in PARALLEL_STAGES
+
+# Work out where a stage runs, 'process' in the process pool, 'io' on the concurrent filesystem layer or 'serial' one
+# file at a time in this process
+def stage_kind(stage, args, workers, io_concurrency):
+    if PROFILE['stage'] == stage.__name__:
+        # The profiler only sees this process
+        return 'serial'
+    if workers > 1 and is_parallel_stage(stage, *args):
+        return 'process'
+    if io_concurrency > 1 and stage in IO_STAGES:
+        return 'io'
+    return 'serial'
+
+# Group consecutive stages that run in the same place into segments
+def split_stage_segments(stages, workers=1, io_concurrency=1):
+    segments = []
+    for stage in stages:
+        kind = stage_kind(stage[0], stage[1:], workers, io_concurrency)
+        if segments and segments[-1][0] == kind:
+            segments[-1][1].append(stage)
+        else:
+            segments.append((kind, [stage]))
+    return segments
+
+# Run the stages for a single file inside a worker and hand back the error instead of raising it. In a worker process
+# collect_stats also hands back the counters and timers of the file and the problems its check stages found, since
+# they would be lost otherwise
+def run_stages_safely(file_path, stages, done, collect_stats=False):
+    if collect_stats:
+        # Drop anything inherited from the parent when the worker was forked
+        take_stats()
+    checks = [(args[0], len(args[0])) for stage, *args in stages if stage in CHECK_STAGES]
+    error = None
+    try:
+        file_path, done = apply_stages(file_path, stages, done)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    if not collect_stats:
+        return file_path, done, error, None
+    problems = [problem_files[size:] for problem_files, size in checks]
+    return file_path, done, error, (take_stats(), problems)
+
+# Run the stages over a chunk of (file path, done) pairs inside a worker process
+def run_chunk_safely(chunk, stages):
+    return [run_stages_safely(file_path, stages, done, True) for file_path, done in chunk]
+
+# Submit the tasks to the pool in chunks and yield the results in order. Only max_pending chunks are in flight at once,
+# so the tasks can come straight from the scanner without all of them being held in memory
+def map_in_pool(executor, tasks, stages, chunksize, max_pending):
+    pending = collections.deque()
+    tasks = iter(tasks)
+    while True:
+        chunk = list(itertools.islice(tasks, chunksize))
+        if chunk:
+            pending.append(executor.submit(run_chunk_safely, chunk, stages))
+        if pending and (len(pending) >= max_pending or not chunk):
+            yield from pending.popleft().result()
+        elif not chunk:
+            return
+
+# Run the stages over every file in a process pool, results come back in the order the files came in and are recorded
+# as they arrive
+def run_stages_in_pool(files, stages, workers, cache=None, journal=None):
+    names = ', '.join(stage.__name__ for stage, *args in stages)
+    check_lists = [args[0] for stage, *args in stages if stage in CHECK_STAGES]
+    # Files still coming from the scanner have no count yet
+    total = len(files) if isinstance(files, list) else None
+    step = max(1, total // 20) if total else 1000
+    # The files handed to the pool whose results have not come back yet
+    in_flight = collections.deque()
+    remaining_files = []
+    errors = 0
+
+    # The cache is only touched from this process, workers just get told which stages to skip
+    def tasks():
+        for entry in files:
+            file_path, done = lookup_entry(cache, entry)
+            if journal is not None:
+                journal.write('begin', path=file_path)
+            in_flight.append((file_path, done))
+            yield file_path, done
+
+    start_time = time.perf_counter()
+    count = 0
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, min(64, total // (workers * 4))) if total else 16
+        for count, result in enumerate(map_in_pool(executor, tasks(), stages, chunksize, workers * 4), 1):
+            original_path, done = in_flight.popleft()
+            file_path, failed = collect_stage_result(original_path, done, result, check_lists, cache, journal)
+            errors += failed
+            if file_path is not None:
+                remaining_files.append(file_path)
+            if count % step == 0 or count == total:
+                logger.info('[%d/%s] %s', count, total or '?', names)
+    elapsed = time.perf_counter() - start_time
+    rate = count / elapsed if elapsed else 0
+    logger.info('%s: %d files in %.1fs (%.1f files/s) on %d workers, %d errors', names, count, elapsed, rate, workers,
+                errors)
+    return remaining_files
+
+# Run the stages over every file on the concurrent filesystem layer, for stages that only make metadata calls
+def run_stages_concurrently(files, stages, concurrency, cache=None, journal=None):
+    names = ', '.join(stage.__name__ for stage, *args in stages)
+    started = []
+
+    # The calls are made as the event loop asks for them, which is in this thread so the cache can be used
+    def calls():
+        for entry in files:
+            file_path, done = lookup_entry(cache, entry)
+            if journal is not None:
+                journal.write('begin', path=file_path)
+            started.append((file_path, done))
+            yield run_stages_safely, (file_path, stages, done)
+
+    results = run_fs_calls(calls(), concurrency, names)
+    remaining_files = []
+    for (original_path, done), result in zip(started, results):
+        file_path, failed = collect_stage_result(original_path, done, result, [], cache, journal)
+        if file_path is not None:
+            remaining_files.append(file_path)
+    return remaining_files
+
+# Handle the result of the stages for a file that ran elsewhere. What a worker process gathered is merged back, with the
+# problems found by its check stages added to check_lists, an error is reported and otherwise the file is recorded in
+# the manifest cache. Returns the path of the file, None if it was removed, and whether it failed
+def collect_stage_result(original_path, done, result, check_lists, cache=None, journal=None):
+    file_path, new_done, error, worker_results = result
+    if worker_results is not None:
+        stats, problems = worker_results
+        merge_stats(stats)
+        for problem_files, found in zip(check_lists, problems):
+            problem_files.extend(found)
+    if error is not None:
+        logger.error('Error processing %s: %s', original_path, error)
+        count_stat('errors')
+        return file_path, True
+    record_stage_result(cache, journal, original_path, file_path, done, new_done)
+    return file_path, False
+
+'''
+Concurrent filesystem operations
+On network shares every rename, delete or chmod is a round trip. These run the blocking calls on a thread pool from an
+asyncio event loop so a bounded number of them are in flight at once, while the results and anything touching the
+manifest cache stay in this thread.
+'''
+
+# Run blocking calls with at most concurrency in flight. calls is an iterable of (func, args) pairs whose funcs must not
+# raise, their results come back in the same order
+def run_fs_calls(calls, concurrency, label='filesystem operations'):
+    start_time = time.perf_counter()
+    results = asyncio.run(gather_fs_calls(calls, concurrency))
+    elapsed = time.perf_counter() - start_time
+    rate = len(results) / elapsed if elapsed else 0
+    logger.info('%s: %d operations in %.1fs (%.1f ops/s) with %d in flight', label, len(results), elapsed, rate,
+                concurrency)
+    return results
+
+async def gather_fs_calls(calls, concurrency):
+    loop = asyncio.get_running_loop()
+    results = {}
+    pending = iter(enumerate(calls))
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Each worker keeps one call in flight and picks up the next one as soon as it is done
+        async def worker():
+            for i, (func, args) in pending:
+                results[i] = await loop.run_in_executor(executor, func, *args)
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return [results[i] for i in range(len(results))]
+
+# Rename a path and hand back the error instead of raising it
+def rename_safely(old_path, new_path):
+    try:
+        with timed('rename'):
+            os.rename(old_path, new_path)
+    except OSError as e:
+        return e
+    return None
+
+'''
+Manifest cache
+A small SQLite database in the root directory remembering, for every file, its size, modification time, a fast hash of
+its content, the stages it already went through and its resulting format and subtype. Files that did not change since
+the last run skip the stages they already passed.
+'''
+
+MANIFEST_CACHE_NAME = '.m8_manifest.sqlite'
+
+# Number of bytes read from each end of a file for the fast content hash
+FAST_HASH_CHUNK = 65536
+
+# Open the manifest cache of a directory tree, or of one shard of it, creating it if needed
+def open_manifest_cache(root_dir, shard=None):
+    cache = sqlite3.connect(os.path.join(root_dir, shard_file_name(MANIFEST_CACHE_NAME, shard)))
+    cache.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT, '
+                  'stages TEXT, format TEXT, subtype TEXT)')
+    if shard is not None:
+        open_shard_cache(root_dir, cache, shard)
+    return cache
+
+# Hash the size and the first and last chunks of a file, enough to tell apart audio files that only had their
+# modification time changed from ones that were actually rewritten
+def fast_content_hash(file_path, size):
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(file_path, 'rb') as f:
+        digest.update(f.read(FAST_HASH_CHUNK))
+        if size > FAST_HASH_CHUNK:
+            f.seek(max(FAST_HASH_CHUNK, size - FAST_HASH_CHUNK))
+            digest.update(f.read(FAST_HASH_CHUNK))
+    return digest.hexdigest()
+
+# Look up the stages a file already went through, an empty set if the file is new or changed since it was recorded.
+# known_stat is the (size, mtime_ns) of the file when the scan already has it
+def lookup_manifest_cache(cache, file_path, known_stat=None):
+    row = cache.execute('SELECT size, mtime, hash, stages FROM files WHERE path = ?', (file_path,)).fetchone()
+    if row is None:
+        return set()
+    size, mtime, content_hash, stages = row
+    if known_stat is None:
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return set()
+        known_stat = st.st_size, st.st_mtime_ns
+    file_size, file_mtime = known_stat
+    if file_size != size:
+        return set()
+    if file_mtime != mtime:
+        # Same size but touched, only trust the record if the content is the same
+        if fast_content_hash(file_path, file_size) != content_hash:
+            return set()
+        cache.execute('UPDATE files SET mtime = ? WHERE path = ?', (file_mtime, file_path))
+    return set(stages.split('\n')) if stages else set()
+
+# Record the stages a file went through under its new path, forgetting the old path if the file moved or was deleted.
+# Returns the row that was written, None if there is none
+def update_manifest_cache(cache, old_path, new_path, done, new_done):
+    if new_path == old_path and new_done == done:
+        # Nothing happened to the file so the record is still up to date
+        return None
+    row = manifest_row(new_path, new_done) if new_path is not None else None
+    write_manifest_row(cache, old_path, row)
+    return row
+
+# Build the manifest cache row of a file as it is now
+def manifest_row(file_path, done):
+    st = os.stat(file_path)
+    try:
+        file_format, subtype = probe_format(file_path)
+    except Exception:
+        file_format, subtype = None, None
+    return (file_path, st.st_size, st.st_mtime_ns, fast_content_hash(file_path, st.st_size), '\n'.join(sorted(done)),
+            file_format, subtype)
+
+# Write a row in place of the record of old_path. A row of None only forgets old_path
+def write_manifest_row(cache, old_path, row):
+    if row is None or row[0] != old_path:
+        cache.execute('DELETE FROM files WHERE path = ?', (old_path,))
+    if row is not None:
+        cache.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+
+# Move the record of a renamed file, or the records of every file below a renamed directory, to the new path. Records
+# already at the new path are out of date and replaced
+def move_manifest_cache_path(cache, old_path, new_path):
+    cache.execute('UPDATE OR REPLACE files SET path = ? WHERE path = ?', (new_path, old_path))
+    prefix = os.path.join(old_path, '')
+    cache.execute('UPDATE OR REPLACE files SET path = ? || substr(path, ?) WHERE substr(path, 1, ?) = ?',
+                  (os.path.join(new_path, ''), len(prefix) + 1, len(prefix), prefix))
+
+'''
+Journal
+While a run with the manifest cache is going it keeps a write ahead journal in the root directory. Every file is noted
+before it goes through the stages and again when it is done, and the rename plan is written out in full before the
+first rename. The manifest cache is committed every few seconds with a checkpoint in the journal. A run that finishes
+deletes its journal. When a run is interrupted, resuming removes the temporary files of the files that were in
+progress, records the files finished since the last checkpoint in the cache and finishes or steps back the renames
+that were under way, so the run picks up exactly where it stopped.
+'''
+
+JOURNAL_NAME = '.m8_journal.jsonl'
+
+# Seconds between commits of the manifest cache
+CHECKPOINT_INTERVAL = 5
+
+# Suffixes of the temporary files the stages write a new version of a file to before it replaces the original
+STAGE_TEMP_SUFFIXES = ['_converted', '_trimmed', '_processed', '_linked']
+
+# Part of the name of every temporary file, so the scanner can leave out the ones other shards are writing
+TEMP_MARKER = '.m8tmp'
+
+# The temporary path a stage writes the new version of a file to, with the extension of the output
+def stage_temp_path(file_path, suffix, extension=None):
+    root, file_extension = os.path.splitext(file_path)
+    return root + suffix + TEMP_MARKER + (extension or file_extension)
+
+# Every temporary path the stages might have left behind for a file
+def stage_temp_paths(file_path):
+    paths = [stage_temp_path(file_path, suffix) for suffix in STAGE_TEMP_SUFFIXES]
+    paths += [stage_temp_path(file_path, suffix, '.wav') for suffix in STAGE_TEMP_SUFFIXES]
+    return sorted(set(paths))
+
+# The write ahead journal of a run, or of the run of one shard
+class Journal:
+    def __init__(self, root_dir, shard=None):
+        self.path = os.path.join(root_dir, shard_file_name(JOURNAL_NAME, shard))
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.last_checkpoint = time.monotonic()
+
+    # Append a record. Every record is handed to the OS right away so it survives the process being killed, sync also
+    # waits for it to reach the disk
+    def write(self, op, sync=False, **fields):
+        self.file.write(json.dumps({'op': op, **fields}) + '\n')
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    # Commit the manifest cache and note that everything before this point is in it, at most every CHECKPOINT_INTERVAL
+    # seconds unless forced
+    def checkpoint(self, cache, force=False):
+        if not force and time.monotonic() - self.last_checkpoint < CHECKPOINT_INTERVAL:
+            return
+        with timed('checkpoint'):
+            cache.commit()
+            self.write('checkpoint', sync=True)
+        self.last_checkpoint = time.monotonic()
+
+    def close(self):
+        self.file.close()
+
+    # Close and delete the journal of a finished run
+    def finish(self):
+        self.file.close()
+        os.remove(self.path)
+
+# Read the records of a journal. A record cut short by the interruption ends it
+def read_journal(journal_path):
+    records = []
+    with open(journal_path, encoding='utf-8') as f:
+        for line in f:
             try:
-                sf.SoundFile(file_path)
-            except Exception as e:
-                if isinstance(e, sf.SoundFileError):
-                    # File is not a valid audio file
-                    if file_extension in [".asd", ".alc", ".DS_Store"]:
-                        # Automatically delete these file types
-                        os.remove(file_path)
-                    elif verbose_permission:
-                        # Prompt user for permission to delete other file types
-                        print(f"{file_path} is not a valid audio file. Do you want to delete it? (y/n)")
-                        user_input = input()
-                        if user_input.lower() == "y":
-                            os.remove(file_path)
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return records
+
+# Bring the tree and the manifest cache back in line with the journal an interrupted run left behind. Returns the
+# levels of its rename plan that are still left to apply, or None if it had not started renaming
+def recover_journal(root_dir, cache, resume, shard=None):
+    journal_path = os.path.join(root_dir, shard_file_name(JOURNAL_NAME, shard))
+    if not os.path.exists(journal_path):
+        return None
+    if not resume:
+        raise RuntimeError(f'{journal_path} was left by an interrupted run. Resume the run to finish it, or delete the '
+                           f'journal to start over')
+    records = read_journal(journal_path)
+    in_progress = {}
+    plan = None
+    renamed = set()
+    last_checkpoint = 0
+    for i, record in enumerate(records):
+        if record['op'] == 'begin':
+            in_progress[record['path']] = True
+        elif record['op'] == 'end':
+            in_progress.pop(record['path'], None)
+        elif record['op'] == 'checkpoint':
+            last_checkpoint = i
+        elif record['op'] == 'plan':
+            plan = record['levels']
+        elif record['op'] == 'renamed':
+            renamed.update(tuple(pair) for pair in record['pairs'])
+
+    # Everything up to the last checkpoint is in the cache, the rest is replayed into it in order
+    finished = 0
+    for record in records[last_checkpoint:]:
+        if record['op'] == 'end':
+            write_manifest_row(cache, record['path'], record['row'])
+            finished += 1
+        elif record['op'] == 'renamed':
+            for old_path, new_path in record['pairs']:
+                move_manifest_cache_path(cache, old_path, new_path)
+    # The files that were in progress may have a half written temporary file next to them
+    for file_path in in_progress:
+        for temp_path in stage_temp_paths(file_path):
+            if os.path.exists(temp_path):
+                logger.info('Removing %s left by the interrupted run', temp_path)
+                remove_file(temp_path)
+    remaining_plan = recover_renames(plan, renamed, cache) if plan is not None else None
+    cache.commit()
+    os.remove(journal_path)
+    logger.info('Resuming the interrupted run, %d files were in progress and %d finished since the last checkpoint',
+                len(in_progress), finished)
+    return remaining_plan
+
+# Settle the renames of an interrupted plan, given the (old path, new path) pairs the journal recorded as renamed, and
+# move the cache records of the entries that were renamed. Returns the levels of the plan that are still left to apply
+def recover_renames(plan, renamed, cache):
+    remaining_plan = []
+    for level in plan:
+        remaining = []
+        moving = {os.path.normcase(old_path) for old_path, new_name in level}
+        for old_path, new_name in level:
+            new_path = os.path.join(os.path.dirname(old_path), new_name)
+            temp_path = old_path + TEMP_MARKER
+            if (old_path, temp_path) in renamed:
+                # The entry was stepped aside for a swap and all of its level had been, so its new name is free
+                if (temp_path, new_path) not in renamed:
+                    if os.path.lexists(temp_path) and rename_safely(temp_path, new_path) is not None:
+                        logger.warning('Unable to move %s to %s', temp_path, new_path)
+                        continue
+                    move_manifest_cache_path(cache, temp_path, new_path)
+            elif os.path.lexists(temp_path):
+                # The run stopped while stepping entries aside, so nothing has taken the old name yet
+                if rename_safely(temp_path, old_path) is not None:
+                    logger.warning('Unable to move %s back to %s', temp_path, old_path)
+                    continue
+                move_manifest_cache_path(cache, temp_path, old_path)
+                remaining.append((old_path, new_name))
+            elif (old_path, new_path) in renamed:
+                continue
+            elif os.path.normcase(new_path) not in moving and os.path.lexists(new_path):
+                # Nothing else is planned onto a name that was not moving, so if the new name exists the entry is there
+                move_manifest_cache_path(cache, old_path, new_path)
+            else:
+                remaining.append((old_path, new_name))
+        if remaining:
+            remaining_plan.append(remaining)
+    return remaining_plan
+
+'''
+Sharded runs
+For libraries too big for one machine the files are split into deterministic shards, by a hash of their path or of
+their top level directory. Each shard runs the per file stages on its own files only, on its own machine or in its own
+process, keeping its own manifest cache and journal in the root directory. Once every shard is done merge_shards folds
+their manifest caches and results into the main one and plans the renames for the whole tree in one place, so names
+are fitted around each other across shard boundaries just like in a single run. Every machine has to see the tree at
+the same path.
+'''
+
+# One shard of a sharded run. by is 'hash' to spread the files evenly by path or 'top' to keep every top level
+# directory on one shard
+Shard = collections.namedtuple('Shard', 'index count by', defaults=('hash',))
+
+# Name of the manifest cache or journal of a shard
+def shard_file_name(name, shard=None):
+    if shard is None:
+        return name
+    return f'{name}.shard-{shard.index}-of-{shard.count}'
+
+# Work out which shard a path belongs to. The same path gives the same shard on every machine
+def shard_index(root_dir, path, shard_count, shard_by='hash'):
+    relative = os.path.relpath(path, root_dir).replace(os.sep, '/')
+    if shard_by == 'top':
+        relative = relative.split('/', 1)[0]
+    digest = hashlib.blake2b(relative.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shard_count
+
+# Check whether a path belongs to a shard
+def in_shard(root_dir, path, shard):
+    return shard_index(root_dir, path, shard.count, shard.by) == shard.index
+
+# Read a value stored in the manifest cache of a shard, None if there is none
+def get_shard_value(cache, key):
+    row = cache.execute('SELECT value FROM shard WHERE key = ?', (key,)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+# Store a value in the manifest cache of a shard
+def set_shard_value(cache, key, value):
+    cache.execute('INSERT OR REPLACE INTO shard VALUES (?, ?)', (key, json.dumps(value)))
+
+# Set up the manifest cache of a shard. The first time it is opened it takes over the records of its files from the
+# main manifest cache, so work done before the library was sharded is still skipped
+def open_shard_cache(root_dir, cache, shard):
+    cache.execute('CREATE TABLE IF NOT EXISTS shard (key TEXT PRIMARY KEY, value TEXT)')
+    if get_shard_value(cache, 'seeded'):
+        return
+    main_path = os.path.join(root_dir, MANIFEST_CACHE_NAME)
+    if os.path.exists(main_path):
+        main_cache = sqlite3.connect(main_path)
+        try:
+            rows = (row for row in main_cache.execute('SELECT * FROM files') if in_shard(root_dir, row[0], shard))
+            cache.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        finally:
+            main_cache.close()
+    set_shard_value(cache, 'seeded', True)
+    cache.commit()
+
+# Store what the run of a shard found for merge_shards, the problem files of each check stage and the counters and
+# timers of the run. Their presence marks the shard as finished
+def save_shard_results(cache, stages):
+    problems = [args[0] for stage, *args in stages if stage in CHECK_STAGES]
+    set_shard_value(cache, 'results', {'problems': problems, 'counters': dict(COUNTERS), 'timers': dict(TIMERS)})
+
+# Run the per file stages over the files of one shard. The rename stages are left for merge_shards
+def run_shard(root_dir, stages, shard, workers=1, io_concurrency=1, scan_filter=None, resume=False):
+    logger.info('Running shard %d of %d', shard.index + 1, shard.count)
+    # A shard forked from a process that already did some work only reports its own
+    take_stats()
+    return run_pipeline(root_dir, stages, workers, True, io_concurrency, scan_filter, resume, shard)
+
+# Once every shard has finished, merge their manifest caches into the main one, add the problem files their check
+# stages found to the lists of the check stages in stages and apply the rename stages to the whole tree
+def merge_shards(root_dir, stages, shard_count, io_concurrency=1, resume=False):
+    paths = [os.path.join(root_dir, shard_file_name(MANIFEST_CACHE_NAME, Shard(index, shard_count)))
+             for index in range(shard_count)]
+    # A resumed merge may already have folded the shards in before it was interrupted while renaming
+    if not (resume and not any(os.path.exists(path) for path in paths)):
+        results = []
+        for index, path in enumerate(paths):
+            if not os.path.exists(path):
+                raise RuntimeError(f'Shard {index + 1} of {shard_count} has not run yet')
+            shard_cache = sqlite3.connect(path)
+            try:
+                results.append(get_shard_value(shard_cache, 'results'))
+            finally:
+                shard_cache.close()
+            if results[-1] is None:
+                raise RuntimeError(f'Shard {index + 1} of {shard_count} has not finished, resume it before merging')
+
+        # Between them the shards hold every record of the main manifest cache, as they took them over when they
+        # started
+        cache = open_manifest_cache(root_dir)
+        try:
+            cache.execute('DELETE FROM files')
+            for path in paths:
+                shard_cache = sqlite3.connect(path)
+                try:
+                    cache.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                      shard_cache.execute('SELECT * FROM files'))
+                finally:
+                    shard_cache.close()
+            cache.commit()
+        finally:
+            cache.close()
+
+        check_lists = [args[0] for stage, *args in stages if stage in CHECK_STAGES]
+        for result in results:
+            for problem_files, found in zip(check_lists, result['problems']):
+                problem_files.extend(found)
+            merge_stats((result['counters'], result['timers']))
+        for path in paths:
+            os.remove(path)
+        logger.info('Merged %d shards', shard_count)
+
+    rename_stages = [stage for stage in stages if stage[0] is rename_file]
+    if rename_stages:
+        return run_pipeline(root_dir, rename_stages, use_cache=True, io_concurrency=io_concurrency, resume=resume)
+    return scan_tree(root_dir)[0]
+
+# Run every shard of a sharded run on this machine, each in its own process, then merge them. This is the same work
+# the machines of a cluster would each do for their own shard
+def run_sharded(root_dir, stages, shard_count, shard_by='hash', workers=1, io_concurrency=1, scan_filter=None,
+                resume=False):
+    processes = []
+    for index in range(shard_count):
+        process = multiprocessing.Process(target=run_shard, args=(root_dir, stages, Shard(index, shard_count, shard_by),
+                                                                  workers, io_concurrency, scan_filter, resume))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+    failed = [index + 1 for index, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'Shards {failed} of {shard_count} failed, run again with resume to finish them')
+    return merge_shards(root_dir, stages, shard_count, io_concurrency, resume)
+
+'''
+Rename planner
+The rename stages are not applied file by file. Once the other stages are done the final name of every file and
+directory is worked out in memory, collisions are resolved against the names already taken in each directory, and the
+renames are then applied in one batch, files first and directories children before parents.
+'''
+
+# Rename a single file right away by applying a string transform to its name, the extension is left untouched. Inside
+# the pipeline this stage is planned for the whole tree instead
+def rename_file(file_path, transform, *args):
+    root, file = os.path.split(file_path)
+    name, ext = os.path.splitext(file)
+    new_name = transform(name, *args)
+    if new_name + ext == file:
+        return file_path
+    taken = {os.path.normcase(entry) for entry in os.listdir(root)}
+    separator = counter_separator(lambda name: transform(name, *args))
+    return apply_renames([[(file_path, plan_name(file, new_name, ext, taken, separator))]])[file_path]
+
+# Compile the transforms of the rename stages into a single function of a name. Runs of transforms that only delete
+# characters are merged into one regex, and results are cached per distinct name
+def compile_name_transforms(rename_stages):
+    steps = []
+    deletions = []
+
+    # Turn the pending run of character deletions into a single step
+    def flush_deletions():
+        if len(deletions) == 1:
+            steps.append((deletions[0], ()))
+        elif deletions:
+            pattern = re.compile('|'.join(CHARACTER_DELETIONS[func] for func in deletions))
+            steps.append((delete_matches, (pattern,)))
+        deletions.clear()
+
+    for func, *args in rename_stages:
+        if func in CHARACTER_DELETIONS:
+            deletions.append(func)
+            continue
+        flush_deletions()
+        steps.append((func, args))
+    flush_deletions()
+
+    @functools.lru_cache(maxsize=None)
+    def transform(name):
+        for func, args in steps:
+            name = func(name, *args)
+        return name
+    return transform
+
+# Pick what goes between a name and its collision counter. An underscore, unless the transform removes it, as the
+# counter would then change again the next time the same stages run
+def counter_separator(transform):
+    return '_' if transform('_') == '_' else ''
+
+# Pick the new name of an entry, adding a counter if the name is already taken in its directory
+def plan_name(old_name, new_name, ext, taken, separator='_'):
+    if not new_name:
+        # Never strip a name down to nothing
+        return old_name
+    candidate = new_name + ext
+    counter = 1
+    while os.path.normcase(candidate) in taken:
+        candidate = f"{new_name}{separator}{counter}{ext}"
+        counter += 1
+        count_stat('collisions')
+    return candidate
+
+# Check whether a name is one plan_name could have given for new_name, either new_name itself or new_name with a
+# collision counter, so an entry an earlier run already renamed can keep its name
+def is_planned_name(old_name, new_name, ext, separator='_'):
+    if old_name == new_name + ext:
+        return True
+    prefix = new_name + separator
+    if not (old_name.startswith(prefix) and old_name.endswith(ext)):
+        return False
+    counter = old_name[len(prefix):len(old_name) - len(ext)]
+    return counter.isdigit() and str(int(counter)) == counter and int(counter) >= 1
+
+# Work out the new name of every file and directory. Returns the (old path, new name) pairs of the entries that change
+# split into levels that are applied one after another, first the files and then the directories one depth at a time
+# with the deepest first. Nothing in a level is inside anything else in it
+def plan_renames(files, dirs, rename_stages):
+    transform = compile_name_transforms(rename_stages)
+    separator = counter_separator(transform)
+    entries = collections.defaultdict(list)
+    for file_path in files:
+        root, file = os.path.split(file_path)
+        name, ext = os.path.splitext(file)
+        entries[root].append((file_path, file, transform(name) or name, ext))
+    for dir_path in dirs:
+        root, dir = os.path.split(dir_path)
+        entries[root].append((dir_path, dir, transform(dir) or dir, ''))
+
+    new_names = {}
+    for root, children in entries.items():
+        # The order of the directory listing differs between systems, sorting keeps the counters the same everywhere
+        children.sort(key=lambda child: child[1])
+        # Names that stay the same keep their spot, then names an earlier run already gave out with a counter, so
+        # running the same stages again changes nothing. The rest are fitted around them
+        taken = {os.path.normcase(old_name) for path, old_name, new_name, ext in children if new_name + ext == old_name}
+        kept = {path for path, old_name, new_name, ext in children if new_name + ext == old_name}
+        for path, old_name, new_name, ext in children:
+            if (path not in kept and is_planned_name(old_name, new_name, ext, separator) and
+                    os.path.normcase(old_name) not in taken):
+                taken.add(os.path.normcase(old_name))
+                kept.add(path)
+        for path, old_name, new_name, ext in children:
+            if path not in kept:
+                new_names[path] = plan_name(old_name, new_name, ext, taken, separator)
+                taken.add(os.path.normcase(new_names[path]))
+
+    plan = [[(file_path, new_names[file_path]) for file_path in files if file_path in new_names]]
+    dir_levels = collections.defaultdict(list)
+    for dir_path in dirs:
+        if dir_path in new_names:
+            dir_levels[dir_path.count(os.sep)].append((dir_path, new_names[dir_path]))
+    plan.extend(dir_levels[depth] for depth in sorted(dir_levels, reverse=True))
+    return plan
+
+# Print the renames a plan would make without touching anything
+def print_rename_plan(plan):
+    count = 0
+    for level in plan:
+        for old_path, new_name in level:
+            logger.info('%s -> %s', old_path, new_name)
+            count += 1
+    logger.info('%d renames planned', count)
+
+# Apply a rename plan one level at a time. Entries whose new name is still held by another entry that is about to move
+# go through a temporary name first. The whole plan goes into the journal before anything is renamed. Returns a dict
+# of the path each entry actually ended up at, an entry keeps its old path when it could not be renamed
+def apply_renames(plan, cache=None, concurrency=1, journal=None):
+    if journal is not None:
+        journal.write('plan', sync=True, levels=plan)
+    renamed = {}
+    for level in plan:
+        level = [(old_path, os.path.join(os.path.dirname(old_path), new_name)) for old_path, new_name in level]
+        moving = {os.path.normcase(old_path) for old_path, new_path in level}
+        swaps = [(old_path, new_path) for old_path, new_path in level if os.path.normcase(new_path) in moving]
+        direct = [(old_path, new_path) for old_path, new_path in level if os.path.normcase(new_path) not in moving]
+
+        # Step the swapping entries aside, then move everything into place
+        temp_paths = {}
+        for (old_path, new_path), moved in zip(swaps, rename_entries([(old, old + TEMP_MARKER) for old, new in swaps],
+                                                                     cache, concurrency, journal)):
+            if moved:
+                temp_paths[old_path] = old_path + TEMP_MARKER
+            else:
+                renamed[old_path] = old_path
+        moves = direct + [(old_path, new_path) for old_path, new_path in swaps if old_path in temp_paths]
+        sources = [temp_paths.get(old_path, old_path) for old_path, new_path in moves]
+        for (old_path, new_path), source, moved in zip(moves, sources, rename_entries(
+                [(source, new_path) for source, (old_path, new_path) in zip(sources, moves)], cache, concurrency,
+                journal)):
+            renamed[old_path] = new_path if moved else source
+    return renamed
+
+# Rename a batch of files or directories, none inside another, and keep the manifest cache and the journal in step.
+# Returns whether each rename worked
+def rename_entries(pairs, cache=None, concurrency=1, journal=None):
+    if concurrency > 1 and len(pairs) > 1:
+        errors = run_fs_calls([(rename_safely, pair) for pair in pairs], concurrency, 'renames')
+    else:
+        errors = [rename_safely(old_path, new_path) for old_path, new_path in pairs]
+    results = []
+    for (old_path, new_path), error in zip(pairs, errors):
+        if error is not None:
+            logger.warning('Unable to rename %s: %s', old_path, error)
+            count_stat('errors')
+        else:
+            count_stat('renames')
+            if cache is not None:
+                move_manifest_cache_path(cache, old_path, new_path)
+        results.append(error is None)
+    if journal is not None:
+        journal.write('renamed', pairs=[pair for pair, moved in zip(pairs, results) if moved])
+        journal.checkpoint(cache)
+    return results
+
+# Work out where every file ended up after its own rename and the renames of the directories above it
+def final_file_paths(files, dirs, renamed):
+    final_dirs = {}
+    for dir_path in dirs:
+        root, dir = os.path.split(dir_path)
+        final_dirs[dir_path] = os.path.join(final_dirs.get(root, root), os.path.basename(renamed.get(dir_path, dir_path)))
+    final_files = []
+    for file_path in files:
+        root = os.path.dirname(file_path)
+        final_files.append(os.path.join(final_dirs.get(root, root), os.path.basename(renamed.get(file_path, file_path))))
+    return final_files
+
+# Print the renames the rename stages of a chain would make to the tree
+def preview_renames(root_dir, stages):
+    files, dirs = scan_tree(root_dir)
+    rename_stages = [args for stage, *args in stages if stage is rename_file]
+    print_rename_plan(plan_renames(files, dirs, rename_stages))
+
+'''
+Name transforms
+Plain string to string functions used by the renaming stages
+'''
+
+PLURAL_SUFFIX_PATTERN = re.compile(r'(?i)(?<=[^s])s|(?<=[^es])es|(?<=[^ies])ies')
+#PLURAL_SUFFIX_PATTERN = re.compile(r'(?i)(?:[^s]|^)s(?=$|[^a-z])|(?i)(?:[^es]|^)es(?=$|[^a-z])|(?i)(?:[^ies]|^)ies(?=$|[^a-z])|(?i)(?:[^\'en]|^)[\'en](?=$|[^a-z])')
+ILLEGAL_CHARACTERS = r'[^a-zA-Z0-9]'
+ILLEGAL_CHARACTER_PATTERN = re.compile(ILLEGAL_CHARACTERS + '+')
+VOWELS = r'[aeiouAEIOU]'
+VOWEL_TABLE = str.maketrans('', '', 'aeiouAEIOU')
+
+def remove_plural_suffixes_from_string(s):
+    return PLURAL_SUFFIX_PATTERN.sub('', s)
+
+def remove_characters_from_string(s):
+    return ILLEGAL_CHARACTER_PATTERN.sub('', s)
+
+# Precomputed table of the shortest WordNet lemma for every word and part of speech, built from the corpus the first
+# time it is needed
+LEMMA_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lemma_table_pos.tsv.gz')
+
+# Suffix substitutions WordNet uses to find the base form of an inflected word of each part of speech. The same as
+# WordNetCorpusReader.MORPHOLOGICAL_SUBSTITUTIONS, copied so abbreviating a name does not need to import nltk
+MORPHOLOGICAL_SUBSTITUTIONS = {
+    'n': [('s', ''), ('ses', 's'), ('ves', 'f'), ('xes', 'x'), ('zes', 'z'), ('ches', 'ch'), ('shes', 'sh'),
+          ('men', 'man'), ('ies', 'y')],
+    'v': [('s', ''), ('ies', 'y'), ('es', 'e'), ('es', ''), ('ed', 'e'), ('ed', ''), ('ing', 'e'), ('ing', '')],
+    'a': [('er', ''), ('est', ''), ('er', 'e'), ('est', 'e')],
+    'r': [],
+}
+
+# Files of irregular forms such as mice -> mouse in the WordNet corpus, for each part of speech
+EXCEPTION_FILES = {'n': 'noun.exc', 'v': 'verb.exc', 'a': 'adj.exc', 'r': 'adv.exc'}
+
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+# Walk every synset in WordNet once and write the shortest lemma of each word and part of speech to table_path.
+# Irregular forms are written as exceptions holding the shortest lemma of their base forms, as WordNet looks them up
+# instead of applying the suffix rules. Returns the lemmas and the exceptions, both keyed by (word, part of speech)
+def build_lemma_table(table_path=LEMMA_TABLE_PATH):
+    logger.info('Building abbreviation table %s from WordNet, this only happens once', table_path)
+    wordnet = nltk.corpus.wordnet
+    lemmas = {}
+    for synset in wordnet.all_synsets():
+        # Satellite adjectives are looked up as adjectives
+        pos = 'a' if synset.pos() == 's' else synset.pos()
+        names = [lemma.name() for lemma in synset.lemmas()]
+        shortest_lemma = min(names, key=len)
+        for name in names:
+            key = (name.lower(), pos)
+            if key not in lemmas or len(shortest_lemma) < len(lemmas[key]):
+                lemmas[key] = shortest_lemma
+    exceptions = {}
+    for pos, file_name in EXCEPTION_FILES.items():
+        with wordnet.open(file_name) as f:
+            for line in f:
+                word, *base_forms = line.split()
+                found = [lemmas[form, pos] for form in [word] + base_forms if (form, pos) in lemmas]
+                exceptions[word, pos] = min(found, key=len) if found else ''
+    # The table only takes its final name once it is complete, so a build that fails half way is started over next time
+    # instead of leaving a truncated table behind. A leftover temporary file is simply overwritten
+    temp_path = stage_temp_path(table_path, '_building')
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        for kind, table in (('lemma', lemmas), ('exception', exceptions)):
+            for (word, pos), shortest_lemma in sorted(table.items()):
+                f.write(f"{kind}\t{word}\t{pos}\t{shortest_lemma}\n")
+    os.replace(temp_path, table_path)
+    return lemmas, exceptions
+
+# Load the abbreviation table, building it first if it does not exist yet
+@functools.lru_cache(maxsize=None)
+def load_lemma_table(table_path=LEMMA_TABLE_PATH):
+    with timed('lemma_table'):
+        if not os.path.exists(table_path):
+            return build_lemma_table(table_path)
+        tables = {'lemma': {}, 'exception': {}}
+        with gzip.open(table_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                kind, word, pos, shortest_lemma = line.rstrip('\n').split('\t')
+                tables[kind][word, pos] = shortest_lemma
+        return tables['lemma'], tables['exception']
+
+# Split a name into words and punctuation
+@functools.lru_cache(maxsize=65536)
+def tokenize_name(s):
+    return tuple(TOKEN_PATTERN.findall(s))
+
+# Replace a word with its shortest synonym if there is one shorter than the word. Like WordNet's morphy each part of
+# speech only applies its own suffix rules against its own words, and an irregular form skips the rules
+@functools.lru_cache(maxsize=65536)
+def abbreviate_word(word):
+    count_stat('abbreviation_lookups')
+    lemmas, exceptions = load_lemma_table()
+    lower = word.lower()
+    found = []
+    for pos, substitutions in MORPHOLOGICAL_SUBSTITUTIONS.items():
+        if (lower, pos) in exceptions:
+            if exceptions[lower, pos]:
+                found.append(exceptions[lower, pos])
+            continue
+        # The word itself and every base form it could be an inflection of
+        forms = [lower] + [lower[:-len(suffix)] + ending for suffix, ending in substitutions if lower.endswith(suffix)]
+        found.extend(lemmas[form, pos] for form in forms if (form, pos) in lemmas)
+    if found:
+        shortest_lemma = min(found, key=len)
+        return shortest_lemma if len(shortest_lemma) < len(word) else word
+    return word
+
+def abbreviate_string(s):
+    return "".join(abbreviate_word(word) for word in tokenize_name(s))
+
+def remove_vowels_from_string(s):
+    return s.translate(VOWEL_TABLE)
+
+def truncate_string(s, length):
+    return s[:length]
+
+def delete_matches(s, pattern):
+    return pattern.sub('', s)
+
+# Transforms that only delete the characters matching a pattern, back to back they can be merged into one pass
+CHARACTER_DELETIONS = {
+    remove_characters_from_string: ILLEGAL_CHARACTERS,
+    remove_vowels_from_string: VOWELS,
+}
+
+# Words the name transform benchmark builds its sample names from
+BENCHMARK_WORDS = ['Kick', 'Snare', 'Hats', 'Loops', 'Bass', 'Pads', 'Vocal', 'Chops', 'Percussion', 'Cymbals', 'Claps',
+                   'Toms', 'Risers', 'Impacts', '808', '909', 'Dry', 'Wet', '(Copy)', '&', '-', '120bpm', 'Am', 'One Shot']
+
+# Time how many names per second the compiled rename stages get through, both for distinct names and repeated ones.
+# Returns a dict of the names per second of each. benchmark.py runs it as its name_transforms benchmark
+def benchmark_name_transforms(rename_stages, count=100000, seed=0):
+    rng = random.Random(seed)
+    names = [' '.join(rng.choice(BENCHMARK_WORDS) for _ in range(rng.randint(1, 5))) + f' {i}' for i in range(count)]
+    results = {}
+    transform = compile_name_transforms(rename_stages)
+    for label in ['distinct', 'repeated']:
+        start_time = time.perf_counter()
+        for name in names:
+            transform(name)
+        elapsed = time.perf_counter() - start_time
+        results[label] = count / elapsed if elapsed else float('inf')
+        logger.debug('%s names: %.0f names/s', label, results[label])
+    return results
+
+'''
+Header probe
+Reads just the RIFF/WAVE chunk headers of a file instead of going through libsndfile, which is all the checks need.
+Anything the probe can not make sense of is left to libsndfile.
+'''
+
+# Number of bytes read up front, enough for the fmt and data chunk headers of nearly every WAV
+PROBE_SIZE = 1024
+
+# Give up looking for the data chunk after this many chunks
+MAX_PROBE_CHUNKS = 32
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# libsndfile subtype names for each format tag and bit depth
+WAV_SUBTYPES = {
+    (WAVE_FORMAT_PCM, 8): 'PCM_U8',
+    (WAVE_FORMAT_PCM, 16): 'PCM_16',
+    (WAVE_FORMAT_PCM, 24): 'PCM_24',
+    (WAVE_FORMAT_PCM, 32): 'PCM_32',
+    (WAVE_FORMAT_IEEE_FLOAT, 32): 'FLOAT',
+    (WAVE_FORMAT_IEEE_FLOAT, 64): 'DOUBLE',
+}
+
+WavHeader = collections.namedtuple('WavHeader', 'format format_tag channels samplerate bit_depth data_length subtype')
+
+# Unpack the fmt chunk of a WAV, None if it is a format the probe does not know
+def parse_fmt_chunk(fmt, data_length):
+    format_tag, channels, samplerate, byte_rate, block_align, bit_depth = struct.unpack('<HHIIHH', fmt[:16])
+    file_format = 'WAVEX' if format_tag == WAVE_FORMAT_EXTENSIBLE else 'WAV'
+    if format_tag == WAVE_FORMAT_EXTENSIBLE:
+        if len(fmt) < 26:
+            return None
+        # The real format tag is the start of the sub format GUID
+        format_tag = struct.unpack('<H', fmt[24:26])[0]
+    subtype = WAV_SUBTYPES.get((format_tag, bit_depth))
+    if subtype is None or channels == 0 or samplerate == 0:
+        return None
+    return WavHeader(file_format, format_tag, channels, samplerate, bit_depth, data_length, subtype)
+
+# Read the format, bit depth, channels, sample rate and data length of a WAV from its chunk headers. Returns None when
+# the file is not a plain RIFF/WAVE or the headers are ambiguous
+def probe_wav(file_path):
+    with open(file_path, 'rb', buffering=0) as f:
+        header = f.read(PROBE_SIZE)
+
+        # Serve reads from the probed bytes and only go back to the file for chunks that lie further in
+        def read_at(offset, size):
+            if offset + size <= len(header):
+                return header[offset:offset + size]
+            f.seek(offset)
+            return f.read(size)
+
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return None
+        fmt = None
+        offset = 12
+        for _ in range(MAX_PROBE_CHUNKS):
+            chunk = read_at(offset, 8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, chunk_size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+            if chunk_id == b'fmt ':
+                fmt = read_at(offset + 8, min(chunk_size, 40))
+                if len(fmt) < 16:
+                    return None
+            elif chunk_id == b'data':
+                return parse_fmt_chunk(fmt, chunk_size) if fmt is not None else None
+            # Chunks are padded to an even size
+            offset += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+# Get the format and subtype of an audio file, only asking libsndfile when the header probe can not tell
+def probe_format(file_path):
+    with timed('probe'):
+        header = probe_wav(file_path)
+    if header is not None:
+        return header.format, header.subtype
+    count_stat('probe_fallbacks')
+    with timed('libsndfile_probe'):
+        info = sf.info(file_path)
+    return info.format, info.subtype
+
+'''
+Per file stages
+'''
+
+# Delete a single file
+def remove_file(file_path):
+    with timed('delete'):
+        os.remove(file_path)
+    count_stat('deletes')
+
+# Enables write permissions for a single file
+def enable_write_permission(file_path):
+    with timed('chmod'):
+        os.chmod(file_path, os.stat(file_path).st_mode | stat.S_IWRITE)
+    return file_path
+
+# Check whether two paths name the same file, also where the filesystem ignores case like on Windows
+def is_same_file(file_path, other_path):
+    if os.path.normcase(file_path) == os.path.normcase(other_path):
+        return True
+    try:
+        return os.path.samefile(file_path, other_path)
+    except OSError:
+        return False
+
+# Check whether writing a file converted from file_path to new_file_path would replace a different file, logging a
+# warning when it would
+def is_taken_by_other_file(file_path, new_file_path):
+    if is_same_file(file_path, new_file_path) or not os.path.lexists(new_file_path):
+        return False
+    logger.warning('Leaving %s as it is, %s already exists', file_path, new_file_path)
+    count_stat('target_exists')
+    return True
+
+# Discard a non audio file or convert an audio file into .WAV
+def convert_file_to_wav(file_path, verbose_permission=True):
+    file_extension = os.path.splitext(file_path)[1]
+    try:
+        probe_format(file_path)
+    except Exception as e:
+        if isinstance(e, sf.SoundFileError):
+            # File is not a valid audio file
+            if file_extension in [".asd", ".alc", ".DS_Store"]:
+                # Automatically delete these file types
+                remove_file(file_path)
+                return None
+            elif verbose_permission:
+                # Prompt user for permission to delete other file types
+                print(f"{file_path} is not a valid audio file. Do you want to delete it? (y/n)")
+                user_input = input()
+                if user_input.lower() == "y":
+                    remove_file(file_path)
+                    return None
+            else:
+                # Automatically delete other file types without prompting
+                remove_file(file_path)
+                return None
+    else:
+        if file_extension not in [".wav"]:
+            # Convert file to WAV
+            logger.debug('Converting %s to WAV', file_path)
+            new_file_path = os.path.splitext(file_path)[0] + ".wav"
+            if is_taken_by_other_file(file_path, new_file_path):
+                return file_path
+            output_filename = stage_temp_path(file_path, '_converted', '.wav')
+            with timed('ffmpeg'):
+                sound = pydub.AudioSegment.from_file(file_path)
+                sound.export(output_filename, format="wav")
+            count_stat('bytes_read', os.path.getsize(file_path))
+            count_stat('bytes_written', os.path.getsize(output_filename))
+            # The finished file replaces any old one in a single step, the original is only removed after that
+            os.replace(output_filename, new_file_path)
+            if not is_same_file(file_path, new_file_path):
+                remove_file(file_path)
+            return new_file_path
+    return file_path
+
+# Delete the file if it is not a WAV
+def delete_non_wav_file(file_path):
+    if not file_path.endswith('.wav'):
+        remove_file(file_path)
+        return None
+    return file_path
+
+# Confirms whether the file is WAV, another type, or corrupt. Corrupt files are collected in corrupt_files
+def check_file(file_path, corrupt_files):
+    if not file_path.endswith('.wav'):
+        logger.warning('%s is not a WAV file', file_path)
+    else:
+        try:
+            probe_format(file_path)
+        except Exception as e:
+            logger.error('%s is corrupt or damaged: %s', file_path, e)
+            corrupt_files.append(file_path)
+    return file_path
+
+# Subtypes that are already 16 bits or less and never need dither
+SHALLOW_SUBTYPES = ["PCM_S8", "PCM_U8", "PCM_16"]
+
+# Add triangular (TPDF) dither of one least significant bit at the target bit depth to a block of float samples
+def tpdf_dither(block, target_bit_depth, rng):
+    lsb = 1.0 / 2 ** (target_bit_depth - 1)
+    block += (rng.random(block.shape) - rng.random(block.shape)) * lsb
+    # Keep the dithered peaks inside the range of the integer format
+    np.clip(block, -1.0, 1.0 - lsb, out=block)
+    return block
+
+# Convert a single audio file to the target bit depth. The file is streamed in blocks of blocksize frames so memory use
+# stays the same no matter how long the file is
+def convert_file_bit_depth(file_path, target_bit_depth, dither=False, blocksize=65536):
+    # Check if the file is an audio file
+    if not (file_path.endswith(".mp3") or file_path.endswith(".wav")):
+        return file_path
+    logger.debug('Converting %s to %d bits', file_path, target_bit_depth)
+    output_filename = stage_temp_path(file_path, '_converted')
+    with sf.SoundFile(file_path) as infile:
+        try:
+            # Open the output file with the desired bit depth
+            outfile = sf.SoundFile(output_filename, 'w', samplerate=infile.samplerate, channels=infile.channels,
+                                   subtype=f'PCM_{target_bit_depth}')
+        except TypeError as e:
+            if "No format specified" in str(e):
+                # Log an error message and continue with the next file
+                logger.warning('Unable to write file %s because the format could not be determined from the file '
+                               'extension', output_filename)
+                return file_path
+            else:
+                # If the error is not related to the format not being specified, re-raise the error
+                raise e
+        except ValueError as e:
+            # The format has no PCM subtype at this bit depth, such as MP3
+            logger.warning('Unable to write file %s: %s', output_filename, e)
+            return file_path
+        # Only dither when the bit depth is actually being reduced to 16 bits or less
+        rng = np.random.default_rng() if dither and target_bit_depth <= 16 and infile.subtype not in SHALLOW_SUBTYPES else None
+        # Every block is read into the same buffer
+        buffer = np.empty((blocksize, infile.channels), dtype='float64')
+        with outfile:
+            for block in infile.blocks(always_2d=True, out=buffer):
+                if rng is not None:
+                    block = tpdf_dither(block, target_bit_depth, rng)
+                outfile.write(block)
+    count_stat('bytes_read', os.path.getsize(file_path))
+    count_stat('bytes_written', os.path.getsize(output_filename))
+    # Replace the original file with the new one in a single step, so one of the two is always there in full
+    os.replace(output_filename, file_path)
+    return file_path
+
+# Subtypes with a bit depth the M8 can not play
+DEEP_SUBTYPES = ["PCM_32", "FLOAT", "DOUBLE"]
+
+# Collect the file in failing_files if its bit depth is not legal for the M8
+def check_file_bit_depth(file_path, failing_files):
+    if file_path.endswith('.wav'):
+        # Check the subtype of the WAV file
+        file_format, subtype = probe_format(file_path)
+        if subtype in DEEP_SUBTYPES:
+            failing_files.append(file_path)
+    return file_path
+
+# Log the result of the bit depth checks
+def report_bit_depth(failing_files):
+    if not failing_files:
+        logger.info('All files are less than 32 bits')
+    else:
+        logger.warning('The following files have a bit depth of at least 32 bits:')
+        for file in failing_files:
+            logger.warning('%s', file)
+
+# Length of the windows used to measure loudness when trimming silence in milliseconds
+TRIM_FRAME_MS = 10
+
+# Compute the RMS level of every window of frame_len samples in one vectorized pass over the whole file
+def framewise_rms(data, frame_len):
+    n_frames = -(-len(data) // frame_len)
+    # Pad the last window with silence so the samples can be viewed as equal sized windows
+    padded = np.zeros((n_frames * frame_len, data.shape[1]), dtype=data.dtype)
+    padded[:len(data)] = data
+    windows = padded.reshape(n_frames, frame_len * data.shape[1])
+    return np.sqrt(np.mean(np.square(windows, dtype='float64'), axis=1))
+
+# Find the first and last sample of the non silent part of the audio, or None if it is silent throughout
+def find_silence_bounds(data, samplerate, threshold_db):
+    frame_len = max(1, int(samplerate * TRIM_FRAME_MS / 1000))
+    rms = framewise_rms(data, frame_len)
+    loud = np.flatnonzero(rms > 10 ** (threshold_db / 20))
+    if len(loud) == 0:
+        return None
+    return loud[0] * frame_len, min(len(data), (loud[-1] + 1) * frame_len)
+
+# Work out which part of the audio to keep when trimming, only cutting silences that last at least min_segment_len
+# milliseconds. Returns None when the audio is silent throughout
+def trim_bounds(data, samplerate, min_segment_len, threshold_db):
+    bounds = find_silence_bounds(data, samplerate, threshold_db)
+    if bounds is None:
+        return None
+    start, end = bounds
+    min_samples = samplerate * min_segment_len / 1000
+    # Only slice silences that are long enough
+    if start < min_samples:
+        start = 0
+    if len(data) - end < min_samples:
+        end = len(data)
+    return start, end
+
+# Removes silences from the beginning and end of a single sample. Silence is anything quieter than threshold_db dBFS
+# and is only cut when it lasts at least min_segment_len milliseconds
+def split_and_trim_file(file_path, min_segment_len, threshold_db=-60):
+    try:
+        # Load the audio file
+        with timed('decode'):
+            info = sf.info(file_path)
+            # float64 holds every sample of PCM_32 and DOUBLE files exactly, so writing the kept part back at the
+            # original subtype loses nothing
+            data, samplerate = sf.read(file_path, dtype='float64', always_2d=True)
+    except sf.SoundFileError as e:
+        # Couldn't decode the file
+        logger.warning('An error occurred while trying to decode %s: %s', file_path, e)
+        count_stat('errors')
+        return file_path
+
+    bounds = trim_bounds(data, samplerate, min_segment_len, threshold_db)
+    if bounds is None:
+        logger.debug('%s is silent, leaving it untouched', file_path)
+        return file_path
+    start, end = bounds
+    if start == 0 and end == len(data):
+        return file_path
+
+    logger.debug('Trimming %d samples from the start and %d samples from the end of %s', start, len(data) - end,
+                 file_path)
+    output_filename = stage_temp_path(file_path, '_trimmed')
+    with timed('encode'):
+        sf.write(output_filename, data[start:end], samplerate, subtype=info.subtype, format=info.format)
+    count_stat('bytes_read', os.path.getsize(file_path))
+    count_stat('bytes_written', os.path.getsize(output_filename))
+    os.replace(output_filename, file_path)
+    return file_path
+
+# Resample audio to a new sample rate by cutting or zero padding its spectrum, which keeps it band limited in both
+# directions
+def resample_audio(data, samplerate, target_samplerate):
+    frames = max(1, round(len(data) * target_samplerate / samplerate))
+    spectrum = np.fft.rfft(data, axis=0)
+    bins = frames // 2 + 1
+    if bins <= len(spectrum):
+        spectrum = spectrum[:bins]
+    else:
+        spectrum = np.concatenate([spectrum, np.zeros((bins - len(spectrum), data.shape[1]), dtype=spectrum.dtype)])
+    return np.fft.irfft(spectrum, frames, axis=0) * (frames / len(data))
+
+# Number of frames process_audio_file streams at a time when it does not need the whole file in memory
+PROCESS_BLOCKSIZE = 65536
+
+# Turn a single audio file into an M8 ready WAV in one pass. The file is decoded once, then resampled to samplerate,
+# trimmed like split_and_trim_file when min_segment_len is set and reduced to target_bit_depth, and the result is
+# written once. Only trimming and resampling need the whole file in memory, otherwise it is streamed through in blocks.
+# Files whose bit depth is not legal for the M8 are collected in failing_files from the same pass. Files that are not
+# audio are left for delete_non_wav_file
+def process_audio_file(file_path, failing_files, target_bit_depth=16, dither=False, samplerate=None,
+                       min_segment_len=None, threshold_db=-60):
+    target_subtype = f'PCM_{target_bit_depth}'
+    with timed('probe'):
+        header = probe_wav(file_path)
+    if header is not None:
+        file_format, subtype = header.format, header.subtype
+    else:
+        try:
+            file_format, subtype = probe_format(file_path)
+        except sf.SoundFileError:
+            # Not an audio file
+            return file_path
+    # Without trimming a WAV that already has the right subtype and sample rate can be judged from its header alone
+    if (min_segment_len is None and header is not None and file_path.endswith('.wav') and file_format == 'WAV' and
+            subtype == target_subtype and samplerate in (None, header.samplerate)):
+        if subtype in DEEP_SUBTYPES:
+            failing_files.append(file_path)
+        return file_path
+    new_file_path = os.path.splitext(file_path)[0] + '.wav'
+    if is_taken_by_other_file(file_path, new_file_path):
+        if subtype in DEEP_SUBTYPES:
+            failing_files.append(file_path)
+        return file_path
+
+    try:
+        infile = sf.SoundFile(file_path)
+    except (sf.SoundFileError, RuntimeError) as e:
+        logger.error('%s is corrupt or damaged: %s', file_path, e)
+        count_stat('errors')
+        if subtype in DEEP_SUBTYPES:
+            failing_files.append(file_path)
+        return file_path
+
+    output_filename = stage_temp_path(file_path, '_processed', '.wav')
+    with infile:
+        source_samplerate = infile.samplerate
+        resampled = samplerate not in (None, source_samplerate)
+        changed = False
+        if min_segment_len is None and not resampled:
+            # Nothing needs the whole file at once, so it is streamed through in blocks like convert_file_bit_depth
+            # and long files take no more memory than short ones
+            blocks = infile.blocks(blocksize=PROCESS_BLOCKSIZE, dtype='float64', always_2d=True)
+        else:
+            try:
+                with timed('decode'):
+                    data = infile.read(dtype='float64', always_2d=True)
+            except (sf.SoundFileError, RuntimeError) as e:
+                logger.error('%s is corrupt or damaged: %s', file_path, e)
+                count_stat('errors')
+                if subtype in DEEP_SUBTYPES:
+                    failing_files.append(file_path)
+                return file_path
+            if min_segment_len is not None:
+                with timed('trim'):
+                    bounds = trim_bounds(data, source_samplerate, min_segment_len, threshold_db)
+                if bounds is not None and bounds != (0, len(data)):
+                    logger.debug('Trimming %d samples from the start and %d samples from the end of %s', bounds[0],
+                                 len(data) - bounds[1], file_path)
+                    data = data[bounds[0]:bounds[1]]
+                    changed = True
+            if resampled:
+                logger.debug('Resampling %s from %d to %d Hz', file_path, source_samplerate, samplerate)
+                with timed('resample'):
+                    data = resample_audio(data, source_samplerate, samplerate)
+                changed = True
+            blocks = [data]
+        if not changed and new_file_path == file_path and file_format == 'WAV' and subtype == target_subtype:
+            # Only trimming was asked for and there was nothing to trim
+            if subtype in DEEP_SUBTYPES:
+                failing_files.append(file_path)
+            return file_path
+
+        # Dither when the bit depth is being reduced to 16 bits or less, or the samples were recomputed by resampling
+        rng = None
+        if dither and target_bit_depth <= 16 and (subtype not in SHALLOW_SUBTYPES or resampled):
+            rng = np.random.default_rng()
+
+        logger.debug('Writing %s as %d bit WAV', new_file_path, target_bit_depth)
+        try:
+            # When the file is streamed the decoding of each block is timed here as well
+            with timed('encode'), sf.SoundFile(output_filename, 'w', samplerate=samplerate or source_samplerate,
+                                               channels=infile.channels, subtype=target_subtype,
+                                               format='WAV') as outfile:
+                for block in blocks:
+                    if rng is not None:
+                        block = tpdf_dither(block, target_bit_depth, rng)
                     else:
-                        # Automatically delete other file types without prompting
-                        os.remove(file_path)
+                        # Keep the peaks inside the range of the integer format
+                        np.clip(block, -1.0, 1.0, out=block)
+                    outfile.write(block)
+        except (sf.SoundFileError, RuntimeError, ValueError) as e:
+            logger.warning('Unable to write file %s: %s', output_filename, e)
+            count_stat('errors')
+            if os.path.exists(output_filename):
+                os.remove(output_filename)
+            if subtype in DEEP_SUBTYPES:
+                failing_files.append(file_path)
+            return file_path
+    count_stat('bytes_read', os.path.getsize(file_path))
+    count_stat('bytes_written', os.path.getsize(output_filename))
+    os.replace(output_filename, new_file_path)
+    # Where the filesystem ignores case the new path can be the original file, which the replace already took care of
+    if not is_same_file(file_path, new_file_path):
+        remove_file(file_path)
+    # The file now has the subtype it was just written with, so there is no need to open it again to check it
+    if target_subtype in DEEP_SUBTYPES:
+        failing_files.append(new_file_path)
+    return new_file_path
+
+# Stages that only touch their own file and are safe to run in worker processes
+PARALLEL_STAGES = {convert_file_to_wav, convert_file_bit_depth, split_and_trim_file, process_audio_file}
+
+# Stages that only make filesystem metadata calls and can run on the concurrent filesystem layer
+IO_STAGES = {enable_write_permission, delete_non_wav_file}
+
+# Stages that give the same result when run twice, the manifest cache skips them for files that already went through
+CACHEABLE_STAGES = {convert_file_to_wav, delete_non_wav_file, convert_file_bit_depth, split_and_trim_file}
+
+# Stages that collect problem files in the list given as their first argument
+CHECK_STAGES = {check_file, check_file_bit_depth, process_audio_file}
+
+# Stages that only read the files, a chain of nothing else leaves the tree exactly as it was
+READ_ONLY_STAGES = {check_file, check_file_bit_depth}
+
+'''
+Duplicate detection
+Sample packs often hold the same audio under different names. Every file is first keyed by the channels, sample rate
+and length its header gives, which costs one small read per file. Only files sharing a key are decoded, into a short
+fingerprint of samples picked at even steps through the file. Files whose fingerprints match within
+FINGERPRINT_TOLERANCE of their level are then compared in full, and only files with the same bytes or the same decoded
+samples count as duplicates, so copies that only differ in bit depth or container are found but no file is ever taken
+for a duplicate of audio it does not hold.
+'''
+
+# Number of frames picked from a file for its fingerprint
+FINGERPRINT_POINTS = 1024
+
+# Number of frames decoded at a time while fingerprinting and comparing files
+FINGERPRINT_BLOCKSIZE = 65536
+
+# Largest difference between two fingerprints relative to their peak, -60 dB, for their files to be compared in full
+FINGERPRINT_TOLERANCE = 10 ** (-60 / 20)
+
+# Smallest difference between two fingerprints that always counts as a match, a couple of 16 bit steps
+FINGERPRINT_FLOOR = 2 ** -14
+
+# Largest difference between two decoded samples that still counts as the same audio. Two 16 bit steps, so a 16 bit
+# export of a deeper master still matches it whether it was rounded or dithered. As large as FINGERPRINT_FLOOR, so any
+# pair that would pass the full comparison also passes the fingerprint
+SAMPLE_TOLERANCE = FINGERPRINT_FLOOR
+
+# Subtypes from the least to the most precise, the most precise copy of a sample is the one kept
+SUBTYPE_PRECISION = ['PCM_U8', 'PCM_S8', 'PCM_16', 'PCM_24', 'PCM_32', 'FLOAT', 'DOUBLE']
+
+# Mark a stage that finds duplicate samples among all the files before the other stages run. With 'skip' the
+# duplicates are left out of the other stages. With 'link' each one is also replaced afterwards by a hard link to the
+# processed copy of the file it duplicates, or by a copy of it where the filesystem has no hard links. On its own it
+# does nothing
+def deduplicate(file_path, mode='skip'):
+    return file_path
+
+# Key a file by its channels, sample rate and length in frames, None if it is not audio. The length is the one
+# libsndfile decodes rather than the one the header claims, as they differ for truncated files and the fingerprint
+# steps by the decoded one
+def audio_shape_key(file_path):
+    try:
+        info = sf.info(file_path)
+        shape = (info.channels, info.samplerate, info.frames)
+    except (sf.SoundFileError, RuntimeError, ValueError, OSError):
+        return None
+    return int.from_bytes(hashlib.blake2b(repr(shape).encode(), digest_size=8).digest(), 'big')
+
+# Pick every channel of at most points frames at even steps through a file. The samples are taken as they are rather
+# than averaged, so bright sounds like hats and cymbals keep what sets them apart. Decodes the file in blocks so long
+# files are never held in memory
+def pcm_fingerprint(file_path, points=FINGERPRINT_POINTS):
+    with sf.SoundFile(file_path) as f:
+        step = max(1, -(-f.frames // points))
+        samples = []
+        # Every block holds a whole number of steps, so the picked frames stay evenly spaced across blocks
+        for block in f.blocks(blocksize=step * max(1, FINGERPRINT_BLOCKSIZE // step), dtype='float32', always_2d=True):
+            samples.append(block[::step].ravel())
+    count_stat('fingerprints')
+    return np.concatenate(samples) if samples else np.zeros(0, dtype=np.float32)
+
+# Check whether two files hold the same audio, either byte for byte or as samples that once decoded differ by no more
+# than SAMPLE_TOLERANCE, as between a master and its export at a lower bit depth or in another lossless format
+def same_audio(file_path, other_path):
+    if os.path.getsize(file_path) == os.path.getsize(other_path):
+        with open(file_path, 'rb') as f, open(other_path, 'rb') as other:
+            while True:
+                chunk = f.read(FAST_HASH_CHUNK)
+                if chunk != other.read(FAST_HASH_CHUNK):
+                    break
+                if not chunk:
+                    return True
+    count_stat('full_compares')
+    with sf.SoundFile(file_path) as f, sf.SoundFile(other_path) as other:
+        if (f.channels, f.samplerate, f.frames) != (other.channels, other.samplerate, other.frames):
+            return False
+        while True:
+            block = f.read(FINGERPRINT_BLOCKSIZE, dtype='float64', always_2d=True)
+            other_block = other.read(FINGERPRINT_BLOCKSIZE, dtype='float64', always_2d=True)
+            if block.shape != other_block.shape:
+                return False
+            if not len(block):
+                return True
+            if np.abs(block - other_block).max() > SAMPLE_TOLERANCE:
+                return False
+
+# Sort order of the files in a group, the first one is kept. The most precise copy comes first so linking never loses
+# resolution, then WAVs as they need the least work
+def keep_order(file_path):
+    try:
+        subtype = sf.info(file_path).subtype
+    except (sf.SoundFileError, RuntimeError, OSError):
+        subtype = None
+    precision = SUBTYPE_PRECISION.index(subtype) if subtype in SUBTYPE_PRECISION else -1
+    return -precision, not file_path.lower().endswith('.wav'), file_path
+
+# Find the duplicates among a group of files with the same audio shape. Returns a dict of each duplicate to the file it
+# duplicates
+def match_fingerprints(group):
+    duplicates = {}
+    inodes = {}
+    kept = []
+    fingerprints = None
+    peaks = np.zeros(len(group), dtype=np.float32)
+    for file_path in sorted(group, key=keep_order):
+        try:
+            file_stat = os.stat(file_path)
+            # A hard link made by an earlier run is the same file and needs no decoding
+            inode = (file_stat.st_dev, file_stat.st_ino)
+            if inode in inodes:
+                duplicates[file_path] = inodes[inode]
+                continue
+            fingerprint = pcm_fingerprint(file_path)
+            peak = np.abs(fingerprint).max(initial=0)
+            # A file that changed since its shape was read can not be compared with the rest of the group
+            if fingerprints is not None and len(fingerprint) != fingerprints.shape[1]:
+                logger.warning('Not checking %s for duplicates, it changed while being read', file_path)
+                continue
+            if kept:
+                distances = np.abs(fingerprints[:len(kept)] - fingerprint).max(axis=1, initial=0)
+                tolerances = np.maximum(np.maximum(peaks[:len(kept)], peak) * FINGERPRINT_TOLERANCE, FINGERPRINT_FLOOR)
+                # Closest candidates first, the first one holding the same audio is the original
+                matches = [index for index in np.argsort(distances) if distances[index] <= tolerances[index]]
+                original = next((kept[index] for index in matches if same_audio(kept[index], file_path)), None)
+                if original is not None:
+                    duplicates[file_path] = original
+                    continue
             else:
-                if file_extension not in [".wav"]:
-                    # Convert file to WAV
-                    print(f"Converting {file_path} to WAV...")
-                    sound = AudioSegment.from_file(file_path)
-                    new_file_path = os.path.splitext(file_path)[0] + ".wav"
-                    sound.export(new_file_path, format="wav")
-                    os.remove(file_path)
+                fingerprints = np.empty((len(group), len(fingerprint)), dtype=np.float32)
+        except (sf.SoundFileError, RuntimeError, ValueError, OSError) as e:
+            logger.warning('Not checking %s for duplicates: %s', file_path, e)
+            continue
+        fingerprints[len(kept)] = fingerprint
+        peaks[len(kept)] = peak
+        inodes[inode] = file_path
+        kept.append(file_path)
+    return duplicates
+
+# Check whether a chain of stages can change anything in the tree. deduplicate only does when it links
+def modifies_files(stages):
+    for stage, *args in stages:
+        if stage is deduplicate:
+            if args and args[0] == 'link':
+                return True
+        elif stage not in READ_ONLY_STAGES:
+            return True
+    return False
+
+# Find the duplicate samples among a list of files or scan entries. The index only holds an 8 byte key per file, so it
+# stays small even for hundreds of thousands of files. Returns a dict of each duplicate to the file it duplicates
+def find_duplicates(files):
+    paths = [entry.path if isinstance(entry, ScanEntry) else entry for entry in files]
+    keys = np.zeros(len(paths), dtype=np.uint64)
+    is_audio = np.zeros(len(paths), dtype=bool)
+    with timed('dedupe_headers'):
+        for index, file_path in enumerate(paths):
+            key = audio_shape_key(file_path)
+            if key is not None:
+                keys[index] = key
+                is_audio[index] = True
+    indices = np.flatnonzero(is_audio)
+    indices = indices[np.argsort(keys[indices], kind='stable')]
+    sorted_keys = keys[indices]
+    # Files sharing a key lie next to each other once sorted, only groups of more than one are decoded
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(indices) else []
+    ends = np.r_[starts[1:], len(indices)] if len(indices) else []
+    duplicates = {}
+    with timed('dedupe_fingerprints'):
+        for start, end in zip(starts, ends):
+            if end - start > 1:
+                duplicates.update(match_fingerprints([paths[index] for index in indices[start:end]]))
+    count_stat('duplicates', len(duplicates))
+    return duplicates
+
+# Replace a duplicate with a hard link to source, or a copy of it where hard links are not possible, taking on the
+# extension of source. Returns the new path of the duplicate and whether it is now a hard link
+def link_file(source, file_path):
+    new_file_path = os.path.splitext(file_path)[0] + os.path.splitext(source)[1]
+    if os.path.exists(new_file_path):
+        if os.path.samefile(source, new_file_path):
+            return new_file_path, False
+        if new_file_path != file_path:
+            logger.warning('Not linking %s to %s, %s already exists', file_path, source, new_file_path)
+            return file_path, False
+    temp_path = stage_temp_path(new_file_path, '_linked')
+    try:
+        os.link(source, temp_path)
+        linked = True
+    except OSError:
+        shutil.copyfile(source, temp_path)
+        linked = False
+    os.replace(temp_path, new_file_path)
+    if new_file_path != file_path:
+        remove_file(file_path)
+    return new_file_path, linked
+
+# Once the other stages are done, link every duplicate to the processed copy of the file it duplicates. files are the
+# paths the stages left. Returns the new paths of the duplicates
+def link_duplicates(duplicates, files):
+    remaining = set(files)
+    new_paths = []
+    saved = 0
+    linked_count = 0
+    with timed('link_duplicates'):
+        for file_path, source in duplicates.items():
+            # The stages may have converted the kept file into a WAV or deleted it
+            wav_path = os.path.splitext(source)[0] + '.wav'
+            source = source if source in remaining else wav_path if wav_path in remaining else None
+            if source is None:
+                new_paths.append(file_path)
+                continue
+            new_path, linked = link_file(source, file_path)
+            if linked:
+                linked_count += 1
+                saved += os.path.getsize(new_path)
+            new_paths.append(new_path)
+    count_stat('duplicate_bytes_saved', saved)
+    logger.info('Linked %d duplicates, saving %.1f MB', linked_count, saved / 1e6)
+    return new_paths
+
+# Log the duplicates that were found and the space they take up
+def report_duplicates(duplicates):
+    size = sum(os.path.getsize(file_path) for file_path in duplicates)
+    for file_path, source in duplicates.items():
+        logger.debug('%s duplicates %s', file_path, source)
+    logger.info('Found %d duplicate samples taking up %.1f MB', len(duplicates), size / 1e6)
+    return size
+
+'''
+Whole tree operations
+Each of these runs a single stage over the whole tree and can be used on its own
+'''
+
+# Enables write permissions for every file in the directory
+def enable_write_permissions(root_dir, io_concurrency=1):
+    run_pipeline(root_dir, [(enable_write_permission,)], io_concurrency=io_concurrency)
+
+# Discard non audio file types and convert remaining files into .WAV
+def convert_to_wav(root_dir, verbose_permission=True, workers=1):
+    run_pipeline(root_dir, [(convert_file_to_wav, verbose_permission)], workers)
 
 # Delete all non-WAV files
-def delete_non_wav_files(root_dir):
-    for root, dirs, files in os.walk(root_dir):
-        for file in files:
-            if not file.endswith('.wav'):
-                file_path = os.path.join(root, file)
-                os.remove(file_path)
+def delete_non_wav_files(root_dir, io_concurrency=1):
+    run_pipeline(root_dir, [(delete_non_wav_file,)], io_concurrency=io_concurrency)
 
 # Confirms whether the files are WAV, another type, or corrupt
 def check_files(root_dir):
     corrupt_files = []
-    for root, dirs, files in os.walk(root_dir):
-        for file in files:
-            file_path = os.path.join(root, file)
-            if not file.endswith('.wav'):
-                print(f'{file_path} is not a WAV file')
-            else:
-                try:
-                    sf.SoundFile(file_path)
-                except Exception as e:
-                    print(f'{file_path} is corrupt or damaged: {e}')
-                    corrupt_files.append(file_path)
+    run_pipeline(root_dir, [(check_file, corrupt_files)])
     return corrupt_files
 
 # Strips plural suffixes
 def remove_plural_suffixes(root_dir):
-    def remove_plural_suffixes(s):
-        print(f"Removing plural suffixes from {root_dir}")
-        pattern = r'(?i)(?<=[^s])s|(?<=[^es])es|(?<=[^ies])ies'
-        #pattern = r'(?i)(?:[^s]|^)s(?=$|[^a-z])|(?i)(?:[^es]|^)es(?=$|[^a-z])|(?i)(?:[^ies]|^)ies(?=$|[^a-z])|(?i)(?:[^\'en]|^)[\'en](?=$|[^a-z])'
-        return re.sub(pattern, '', s)
-
-    for root, dirs, files in os.walk(root_dir):
-        # Remove plural suffixes from the directory names
-        for i, dir in enumerate(dirs):
-            print(f"Removing plurals from directory {dir}")
-            old_name = os.path.join(root, dir)
-            new_name = remove_plural_suffixes(dir)
-            new_name = os.path.join(root, new_name)
-            try:
-                os.rename(old_name, new_name)
-            except FileNotFoundError:
-                # Handle the error here
-                pass
-        # Remove plural suffixes from the file names
-        for file in files:
-            print(f"Removing plurals from file {file}")
-            old_file_path = os.path.join(root, file)
-            name, ext = os.path.splitext(file)
-            new_name = remove_plural_suffixes(name)
-            new_file_path = os.path.join(root, new_name + ext)
-            if old_file_path != new_file_path:
-                try:
-                    os.rename(old_file_path, new_file_path)
-                except FileNotFoundError:
-                    # Handle the error here
-                    pass
+    run_pipeline(root_dir, [(rename_file, remove_plural_suffixes_from_string)])
 
 # Remove redundant and illegal characters from files and folders
 def remove_characters_from_filenames(root_dir):
-    def remove_characters_from_string(s):
-        return re.sub(r'[^a-zA-Z0-9]', '', s)
-
-    def process_directories(root, dirs):
-        subdirs = []
-        for dir in dirs:
-            old_name = os.path.join(root, dir)
-            new_name = remove_characters_from_string(dir)
-            if old_name != os.path.join(root, new_name):
-                os.rename(old_name, os.path.join(root, new_name))
-                subdirs.append(new_name)
-        return subdirs
-
-    def process_files(root, files):
-        for file in files:
-            old_file_path = os.path.join(root, file)
-            name, ext = os.path.splitext(file)
-            new_name = remove_characters_from_string(name)
-            new_file_path = os.path.join(root, new_name + ext)
-            counter = 1
-            while os.path.exists(new_file_path):
-                new_name = f"{new_name}_{counter}"
-                new_file_path = os.path.join(root, new_name + ext)
-                counter += 1
-            if old_file_path != new_file_path:
-                os.rename(old_file_path, new_file_path)
-
-    subdirs = []
-    for root, dirs, files in os.walk(root_dir):
-        subdirs = process_directories(root, dirs)
-        process_files(root, files)
-        for subdir in subdirs:
-            remove_characters_from_filenames(os.path.join(root, subdir))
+    run_pipeline(root_dir, [(rename_file, remove_characters_from_string)])
 
 # Use a language model to shorten names with synsets
 def abbreviate_filenames(root_dir):
-    def abbreviate_string(s):
-        words = nltk.word_tokenize(s)
-        abbreviated_words = []
-        for word in words:
-            synonyms = nltk.corpus.wordnet.synsets(word)
-            if synonyms:
-                lemmas = [lemma.name() for synset in synonyms for lemma in synset.lemmas()]
-                shortest_lemma = min(lemmas, key=len)
-                abbreviated_words.append(shortest_lemma if len(shortest_lemma) < len(word) else word)
-            else:
-                abbreviated_words.append(word)
-        return "".join(abbreviated_words)
-
-    def process_directories(root, dirs):
-        subdirs = []
-        for dir in dirs:
-            old_name = os.path.join(root, dir)
-            new_name = abbreviate_string(dir)
-            if old_name != os.path.join(root, new_name):
-                os.rename(old_name, os.path.join(root, new_name))
-                subdirs.append(new_name)
-        return subdirs
-
-    def process_files(root, files):
-        for file in files:
-            old_file_path = os.path.join(root, file)
-            name, ext = os.path.splitext(file)
-            new_name = abbreviate_string(name)
-            new_file_path = os.path.join(root, new_name + ext)
-            counter = 1
-            while os.path.exists(new_file_path):
-                new_name = f"{new_name}_{counter}"
-                new_file_path = os.path.join(root, new_name + ext)
-                counter += 1
-            if old_file_path != new_file_path:
-                os.rename(old_file_path, new_file_path)
-
-    subdirs = []
-    for root, dirs, files in os.walk(root_dir):
-        subdirs = process_directories(root, dirs)
-        process_files(root, files)
-        for subdir in subdirs:
-            abbreviate_filenames(os.path.join(root, subdir))
-
-# # Strip vowel characters from names
-def remove_vowels(root_dir):
-    def remove_vowels_from_string(s):
-        pattern = r'[aeiouAEIOU]'
-        return re.sub(pattern, '', s)
-
-    def process_directories(root, dirs):
-        subdirs = []
-        for dir in dirs:
-            old_name = os.path.join(root, dir)
-            new_name = remove_vowels_from_string(dir)
-            if old_name != os.path.join(root, new_name):
-                try:
-                    os.rename(old_name, os.path.join(root, new_name))
-                except PermissionError:
-                    print(f'PermissionError: Unable to rename {old_name}')
-            subdirs.append(new_name)
-        return subdirs
-
-    def process_files(root, files):
-        for file in files:
-            old_file_path = os.path.join(root, file)
-            name, ext = re.split(f"{os.extsep}(?!.*{os.extsep})", file)
-            new_name = remove_vowels_from_string(name)
-            counter = 1
-            while os.path.exists(os.path.join(root, f"{new_name}{ext}")):
-                new_name = f"{new_name}_{counter}"
-                counter += 1
-            if old_file_path != os.path.join(root, f"{new_name}{ext}"):
-                try:
-                    os.rename(old_file_path, os.path.join(root, f"{new_name}{ext}"))
-                except PermissionError:
-                    print(f'PermissionError: Unable to rename {old_file_path}')
+    run_pipeline(root_dir, [(rename_file, abbreviate_string)])
 
-    subdirs = []
-    for root, dirs, files in os.walk(root_dir, followlinks=True):
-        subdirs = process_directories(root, dirs)
-        process_files(root, files)
-        for subdir in subdirs:
-            remove_vowels(os.path.join(root, subdir))
+# Strip vowel characters from names
+def remove_vowels(root_dir):
+    run_pipeline(root_dir, [(rename_file, remove_vowels_from_string)])
 
 # Clip filename and directory name lengths
 def truncate_names(root_dir, length):
-    # Enable write permissions for all files and directories
-    enable_write_permissions(root_dir)
-
-    file_names = {}  # Dictionary to store the new names of the files
-
-    # Truncate file names
-    for root, dirs, files in os.walk(root_dir):
-        for file in files:
-            f = Path(file)
-            name, ext = f.stem, f.suffix
-            if len(name) > length:
-                old_name = os.path.join(root, file)
-                new_name = os.path.join(root, name[:length] + ext)
-                counter = 1
-                while os.path.exists(new_name):
-                    new_name = os.path.join(root, name[:length] + "-" + str(counter) + ext)
-                    counter += 1
-                try:
-                    os.rename(old_name, new_name)
-                except PermissionError:
-                    # Skip the file or directory that caused the error
-                    continue
-                file_names[old_name] = new_name  # Store the new name in the dictionary
-
-    # Truncate directory names
-    for root, dirs, files in os.walk(root_dir):
-        for dir in dirs:
-            if len(dir) > length:
-                old_name = os.path.join(root, dir)
-                new_name = os.path.join(root, dir[:length])
-                counter = 1
-                while os.path.exists(new_name):
-                    new_name = os.path.join(root, dir[:length] + "-" + str(counter))
-                    counter += 1
-                try:
-                    os.rename(old_name, new_name)
-                except PermissionError:
-                    # Skip the file or directory that caused the error
-                    continue
-
-                # Update the names of the files in the directory
-                for file in files:
-                    old_file_name = os.path.join(old_name, file)
-                    new_file_name = os.path.join(new_name, file)
-                    if old_file_name in file_names:
-                        file_names[new_file_name] = file_names[old_file_name]
-                        del file_names[old_file_name]
+    run_pipeline(root_dir, [(enable_write_permission,), (rename_file, truncate_string, length)])
 
 # Traverse the directory tree and convert all audio files bitdepth
-def convert_bit_depth(root_dir, target_bit_depth):
-    # Use os.walk() to loop through all the subdirectories in the tree
-    for root, dirs, files in os.walk(root_dir):
-        # Loop through all the files in the current directory
-        for filename in files:
-            # Check if the file is an audio file
-            if filename.endswith(".mp3") or filename.endswith(".wav"):
-                # Set the input and output filenames
-                input_filename = os.path.join(root, filename)
-                print(f"Converting {input_filename} to {target_bit_depth} bits")
-                # Get the base name and extension of the input file
-                filename, file_extension = os.path.splitext(input_filename)
-                output_path = os.path.dirname(input_filename)
-                output_filename = os.path.join(output_path, filename + "_converted" + file_extension)
-                # Read the audio data from the input file
-                data, samplerate = sf.read(input_filename)
-                try:
-                    # Write the audio data to the output file with the desired bit depth
-                    sf.write(output_filename, data, samplerate, subtype=f'PCM_{target_bit_depth}')
-                except TypeError as e:
-                    if "No format specified" in str(e):
-                        print(
-                            f"Unable to write file {output_filename} because the format could not be determined from the file extension")
-                        # Print an error message and continue with the next file
-                        continue
-                    else:
-                        # If the error is not related to the format not being specified, re-raise the error
-                        raise e
-                # Delete the original file and rename the new file
-                os.remove(input_filename)
-                os.rename(output_filename, input_filename)
+def convert_bit_depth(root_dir, target_bit_depth, workers=1, dither=False):
+    run_pipeline(root_dir, [(convert_file_bit_depth, target_bit_depth, dither)], workers)
 
 # Double check to make sure bitdepth was downsampled properly
 def check_bit_depth(root_dir):
-    all_files_32bit = True
     failing_files = []
-    for root, dirs, files in os.walk(root_dir):
-        for file in files:
-            if file.endswith('.wav'):
-                file_path = os.path.join(root, file)
-                with sf.SoundFile(file_path) as f:
-                    # Check the subtype of the WAV file
-                    if f.subtype in ["PCM_32", "FLOAT"]:
-                        all_files_32bit = False
-                        failing_files.append(file_path)
-    if all_files_32bit:
-        print('All files are less than 32 bits')
-    else:
-        print('The following files have a bit depth of at least 32 bits:')
-        for file in failing_files:
-            print(file)
+    run_pipeline(root_dir, [(check_file_bit_depth, failing_files)])
+    report_bit_depth(failing_files)
 
 # Removes silences from the beginning and end of smaples
-def split_and_trim_all(root_dir, min_segment_len):
-    # Recursively traverse the directory tree
-    for root, dirs, files in os.walk(root_dir):
-        # Split and trim each audio file
-        for file in files:
-            file_path = os.path.join(root, file)
-            try:
-                # Load the audio file
-                sound = AudioSegment.from_file(file_path)
-            except pydub.exceptions.CouldntDecodeError as e:
-                # Couldn't decode the file
-                print(f"An error occurred while trying to decode {file_path}: {e}")
-                continue
+def split_and_trim_all(root_dir, min_segment_len, threshold_db=-60, workers=1):
+    run_pipeline(root_dir, [(split_and_trim_file, min_segment_len, threshold_db)], workers)
+
+# Convert, resample, trim and reduce the bit depth of every audio file in one pass, then report the files that are
+# still not legal for the M8
+def process_audio(root_dir, target_bit_depth, dither=False, samplerate=None, min_segment_len=None, threshold_db=-60,
+                  workers=1):
+    failing_files = []
+    run_pipeline(root_dir, [(process_audio_file, failing_files, target_bit_depth, dither, samplerate, min_segment_len,
+                             threshold_db)], workers)
+    report_bit_depth(failing_files)
+    return failing_files
+
+# Find the duplicate samples in the tree. With 'link' each one is replaced by a hard link to the file it duplicates
+def deduplicate_samples(root_dir, mode='skip'):
+    run_pipeline(root_dir, [(deduplicate, mode)])
+
+'''
+Command line
+Every setting of the main program can be given on the command line or in a JSON config file, with the command line
+taking precedence. The stages are picked by the names of their whole tree operations and run in the order given.
+'''
+
+# Stages that can be picked with --stages, each with a function building its stage from the parsed options
+CLI_STAGES = {
+    'deduplicate_samples': lambda options: (deduplicate, options.dedupe_mode),
+    'convert_to_wav': lambda options: (convert_file_to_wav, options.verbose_permissions),
+    'check_files': lambda options: (check_file, options.corrupt_files),
+    'delete_non_wav_files': lambda options: (delete_non_wav_file,),
+    'remove_plural_suffixes': lambda options: (rename_file, remove_plural_suffixes_from_string),
+    'remove_characters_from_filenames': lambda options: (rename_file, remove_characters_from_string),
+    'abbreviate_filenames': lambda options: (rename_file, abbreviate_string),
+    'remove_vowels': lambda options: (rename_file, remove_vowels_from_string),
+    'enable_write_permissions': lambda options: (enable_write_permission,),
+    'truncate_names': lambda options: (rename_file, truncate_string, options.max_name_length),
+    'convert_bit_depth': lambda options: (convert_file_bit_depth, options.target_bit_depth, options.dither),
+    'check_bit_depth': lambda options: (check_file_bit_depth, options.failing_files),
+    'split_and_trim_all': lambda options: (split_and_trim_file, options.min_segment_len, options.silence_threshold),
+    # Converts, resamples and reduces the bit depth of each file in a single decode and checks the result, in place of
+    # the convert_to_wav, convert_bit_depth and check_bit_depth stages
+    'process_audio': lambda options: (process_audio_file, options.failing_files, options.target_bit_depth,
+                                      options.dither, options.target_samplerate,
+                                      *((options.min_segment_len, options.silence_threshold) if options.trim else ())),
+}
+
+# The stages the script ran before they could be picked, a bare run converts nothing but the bit depth
+DEFAULT_STAGES = ['convert_bit_depth', 'check_bit_depth']
 
-            # Split the audio file into segments based on periods of silence
-            segments = []
-            start = 0
-            while start < len(sound):
-                end = start + min_segment_len  # Split the audio file into segments of min_segment_len milliseconds
-                segment = sound[start:end]
-                rms = segment.rms
-                if rms < 50:  # Threshold for silence
-                    # Append the segment to the list of segments
-                    segments.append(segment)
-                start = end
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
 
-            # Trim the segments that are too short
-            segments = [segment for segment in segments if len(segment) > min_segment_len]
+# Parse the command line, filling in the settings it leaves out from the config file given with --config
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Prepare a directory tree of samples for use in the Dirtywave M8')
+    parser.add_argument('root_dir', nargs='?', help='directory where the audio files are located')
+    parser.add_argument('--config', help='JSON file of settings named like the options, such as {"workers": 4}')
+    parser.add_argument('--stages', nargs='+', default=DEFAULT_STAGES, metavar='STAGE',
+                        help=f'stages to run in order, out of {", ".join(CLI_STAGES)}. {" ".join(DEFAULT_STAGES)} by '
+                             f'default')
+    parser.add_argument('--max-name-length', type=int, default=12, help='max length of file and folder names')
+    parser.add_argument('--min-segment-len', type=int, default=250,
+                        help='length of silence in milliseconds at the start and end of a sample needed to trim it')
+    parser.add_argument('--silence-threshold', type=float, default=-60,
+                        help='level in dBFS below which audio counts as silence when trimming')
+    parser.add_argument('--target-bit-depth', type=int, default=16,
+                        help='bit depth to convert to, the M8 supports less than 32 bits but 16 is recommended')
+    parser.add_argument('--dither', action='store_true',
+                        help='add TPDF dither when reducing the bit depth to 16 bits or less')
+    parser.add_argument('--target-samplerate', type=int,
+                        help='sample rate in Hz process_audio resamples every file to, the original rate by default')
+    parser.add_argument('--trim', action='store_true', help='also trim silences in process_audio')
+    parser.add_argument('--dedupe-mode', choices=['skip', 'link'], default='skip',
+                        help='whether deduplicate_samples only leaves duplicates out of the other stages or also '
+                             'replaces them with hard links')
+    parser.add_argument('--verbose-permissions', action='store_true',
+                        help='ask before deleting files that are not audio instead of deleting them')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only print the renames the stages would make without changing anything')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes used for converting files, 1 converts them one at a time')
+    parser.add_argument('--io-concurrency', type=int, default=32,
+                        help='deletes, permission changes and renames kept in flight, raise it for network shares')
+    parser.add_argument('--cache', dest='use_cache', action='store_true', default=None,
+                        help='remember finished work in a manifest in root_dir so unchanged files are skipped next '
+                             'run, on by default unless every stage only reads the files')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help='do not remember finished work in a manifest in root_dir')
+    parser.add_argument('--resume', action='store_true', help='finish a run that was interrupted')
+    parser.add_argument('--shard-count', type=int, default=1,
+                        help='number of shards to split the files into so several machines can share the work')
+    parser.add_argument('--shard-by', choices=['hash', 'top'], default='hash',
+                        help="'hash' spreads the files evenly over the shards, 'top' keeps each top level folder on "
+                             "one shard")
+    parser.add_argument('--shard-index', type=int,
+                        help='shard (0 to shard-count - 1) this machine runs, every shard runs here by default')
+    parser.add_argument('--merge-only', action='store_true',
+                        help='merge the finished shards and apply the renames, run once when every shard is done')
+    parser.add_argument('--include-extensions', nargs='+', metavar='EXTENSION',
+                        help='extensions like .wav .flac the stages process, every file by default')
+    parser.add_argument('--exclude-extensions', nargs='+', metavar='EXTENSION',
+                        help='extensions the stages leave alone, files left out are still renamed, not deleted')
+    parser.add_argument('--min-file-size', type=int, help='files smaller than this many bytes skip the stages')
+    parser.add_argument('--max-file-size', type=int, help='files larger than this many bytes skip the stages')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='INFO',
+                        help='DEBUG also logs every file as it is processed, WARNING only problems')
+    parser.add_argument('--profile-stage', help="stage to profile, by its --stages name such as 'convert_bit_depth' or the function it "
+                             "runs on each file such as 'convert_file_bit_depth'")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='also track the peak memory of the profiled stage')
+    parser.add_argument('--report-path', help='JSON file to write the counters, timers and profile of the run to')
+    parser.add_argument('--import-time', action='store_true',
+                        help='log how long the modules took to import and which ones were never needed')
 
-            # Save the segments to new files
-            for i, segment in enumerate(segments):
-                new_file_path = f"{file_path.rsplit('.', 1)[0]}_{i + 1}.wav"
-                segment.export(new_file_path, format="wav")
+    options = parser.parse_args(argv)
+    if options.config:
+        with open(options.config) as f:
+            config = json.load(f)
+        unknown = sorted(set(config) - set(vars(options)) - {'config'})
+        if unknown:
+            parser.error(f'unknown settings in {options.config}: {", ".join(unknown)}')
+        # Settings given on the command line win over the config file
+        parser.set_defaults(**config)
+        options = parser.parse_args(argv)
+    if options.root_dir is None:
+        parser.error('root_dir must be given on the command line or in the config file')
+    unknown = [name for name in options.stages if name not in CLI_STAGES]
+    if unknown:
+        parser.error(f'unknown stages: {", ".join(unknown)}')
+    options.corrupt_files = []
+    options.failing_files = []
+    if options.profile_stage:
+        # A stage can be profiled by its --stages name or by the function it runs on each file. Renames and duplicate
+        # detection work on the whole tree at once rather than file by file, so they can not be profiled
+        stage_functions = {name: build(options)[0].__name__ for name, build in CLI_STAGES.items()}
+        stage_functions = {name: function for name, function in stage_functions.items()
+                           if function not in ('rename_file', 'deduplicate')}
+        options.profile_stage = stage_functions.get(options.profile_stage, options.profile_stage)
+        if options.profile_stage not in stage_functions.values():
+            parser.error(f'can not profile {options.profile_stage}, pick one of {", ".join(stage_functions)} or '
+                         f'{", ".join(sorted(set(stage_functions.values())))}')
+    if options.log_level not in LOG_LEVELS:
+        parser.error(f'log_level must be one of {", ".join(LOG_LEVELS)}')
+    if options.shard_index is not None and not 0 <= options.shard_index < options.shard_count:
+        parser.error('shard_index must be between 0 and shard_count - 1')
+    return options
+
+# Time it took to import this module
+MODULE_IMPORT_TIME = time.perf_counter() - START_TIME
 
 '''
 Main program
-you can rearrange these functions below into any order you prefer, delete or comment our functions don't wish to use and
-even add your own functionality.
+Run python main.py --help for every option. The stages run in the order they are given to --stages, and the tree is
+only scanned once no matter how many stages are enabled. For example:
+python main.py C:/Users/Jake/Desktop/Tree --stages convert_to_wav delete_non_wav_files remove_characters_from_filenames
+python main.py C:/Users/Jake/Desktop/Tree --stages check_files check_bit_depth --import-time
 '''
 
 if __name__ == '__main__':
+    options = parse_arguments()
+
+    logging.basicConfig(level=getattr(logging, options.log_level), format='%(message)s')
+    if options.profile_stage:
+        enable_profiling(options.profile_stage, options.profile_memory)
+
+    stages = [CLI_STAGES[name](options) for name in options.stages]
+    root_dir = options.root_dir
+    # A run that only checks the files leaves no manifest or journal behind in the tree
+    use_cache = modifies_files(stages) if options.use_cache is None else options.use_cache
+
+    scan_filter = ScanFilter(options.include_extensions, options.exclude_extensions, options.min_file_size,
+                             options.max_file_size)
+    if options.dry_run:
+        preview_renames(root_dir, stages)
+    elif options.shard_count > 1 and options.merge_only:
+        merge_shards(root_dir, stages, options.shard_count, options.io_concurrency, options.resume)
+    elif options.shard_count > 1 and options.shard_index is not None:
+        run_shard(root_dir, stages, Shard(options.shard_index, options.shard_count, options.shard_by), options.workers,
+                  options.io_concurrency, scan_filter, options.resume)
+    elif options.shard_count > 1:
+        run_sharded(root_dir, stages, options.shard_count, options.shard_by, options.workers, options.io_concurrency,
+                    scan_filter, options.resume)
+    else:
+        run_pipeline(root_dir, stages, options.workers, use_cache, options.io_concurrency, scan_filter, options.resume)
+
+    if 'check_bit_depth' in options.stages or 'process_audio' in options.stages:
+        report_bit_depth(options.failing_files)
 
-    # Set the directory where the audio files are located
-    root_dir = 'C:/Users/Jake/Desktop/Tree'
-
-    # Set variables
-    max_name_length = 12 # Desired max length of file and folder names
-    min_segment_len = 250 # Length of silence at beginning and end of sample required to slice silences in milliseconds
-    target_bit_depth = 16 # Set desired bitdepth, M8 supports bit depths less than 32bits but 16bit is recommended
-    Verbose_Permissions = False # 'True' enables user permissions before deletion of files. False deletes all non audio files
-
-    # Operations
-    # convert_to_wav(root_dir, Verbose_Permissions)
-    #
-    # check_files(root_dir)
-    #
-    # delete_non_wav_files(root_dir)
-    #
-    # remove_plural_suffixes(root_dir)
-    #
-    # remove_characters_from_filenames(root_dir)
-    #
-    # # abbreviate_filenames(root_dir)
-    #
-    # # remove_vowels(root_dir)
-    #
-    # truncate_names(root_dir, max_name_length)
-
-    convert_bit_depth(root_dir, target_bit_depth) # CHECK THIS FUNCTION
-
-    check_bit_depth(root_dir)
-
-    # split_and_trim_all(root_dir, min_segment_len) # EXPERIMENTAL Try in a small batch first.
-
-    print("Done")
+    log_run_report(options.report_path)
+    if options.import_time:
+        log_import_times()
+    logger.info("Done")